@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of HTTPUtil.create_ssl_connection racing
+
+usage: bench_connect.py [proxy.py ...]
+
+Connects to a local TLS listener by a name resolving to 4 ips, 3 of which
+refuse the connection, and reports connect latency and the peak count of
+extra threads (Linux /proc) while connecting.
+"""
+
+import sys
+import os
+import ssl
+import time
+import socket
+import threading
+
+import benchutil
+
+COUNT = 200
+
+
+def serve_tls():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(benchutil.GOPROXY_DIR, 'CA.crt'))
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(512)
+
+    def handle(sock):
+        try:
+            sock = context.wrap_socket(sock, server_side=True)
+            sock.recv(16)
+        except (OSError, ValueError):
+            pass
+        finally:
+            sock.close()
+
+    def loop():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=handle, args=(sock,), daemon=True).start()
+    threading.Thread(target=loop, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def thread_count():
+    return len(os.listdir('/proc/self/task'))
+
+
+def bench(label, proxy, port):
+    http_util = proxy.http_util
+    http_util.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    http_util.ssl_context.check_hostname = False
+    http_util.ssl_context.verify_mode = ssl.CERT_NONE
+    # only 127.0.0.1 listens, the other loopback ips refuse
+    http_util.dns['bench.test'] = ['127.0.0.1', '127.0.0.2', '127.0.0.3', '127.0.0.4']
+    base = thread_count()
+    peak = [base]
+    stopped = []
+
+    def sample():
+        while not stopped:
+            peak[0] = max(peak[0], thread_count())
+            time.sleep(0.001)
+    threading.Thread(target=sample, daemon=True).start()
+    latencies = []
+    for i in range(COUNT):
+        start_time = time.time()
+        sock = http_util.create_ssl_connection(('bench.test', port), 4)
+        latencies.append(time.time() - start_time)
+        sock.close()
+    stopped.append(1)
+    latencies.sort()
+    # the sampler thread itself counts as one
+    print('%-24s p50=%.2fms p90=%.2fms peak extra threads=%d' % (label, latencies[COUNT//2]*1000, latencies[COUNT*9//10]*1000, peak[0] - base))
+
+
+def main():
+    port = serve_tls()
+    for label, proxy in benchutil.load_proxies(sys.argv[1:]):
+        bench(label, proxy, port)
+
+
+if __name__ == '__main__':
+    main()
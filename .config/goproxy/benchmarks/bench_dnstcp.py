@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of pooled pipelined DNS over TCP against connect per query
+
+usage: bench_dnstcp.py [proxy.py]
+
+A local stand-in TCP DNS server answers every query after 5ms, out of order.
+32 threads send 50 queries each, once with a fresh connection per query as
+the baseline did, and once through DNSUtil.tcp_pool.  Every reply is checked
+for the id and answer of its own query.
+"""
+
+import sys
+import time
+import struct
+import socket
+import threading
+import socketserver
+
+import benchutil
+
+THREADS = 32
+QUERIES = 50
+ANSWER_DELAY = 0.005
+
+
+def serve_dns(DNSUtil):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            rfile = self.request.makefile('rb')
+            lock = threading.Lock()
+            while True:
+                size = rfile.read(2)
+                if len(size) < 2:
+                    return
+                query = DNSUtil.parse_message(rfile.read(struct.unpack('>H', size)[0]))
+                threading.Thread(target=self.reply, args=(query, lock), daemon=True).start()
+
+        def reply(self, query, lock):
+            time.sleep(ANSWER_DELAY)
+            qname = query.questions[0][0]
+            data = DNSUtil.pack_message(DNSUtil.Message(query.id, 0x8180, query.questions, [DNSUtil.Record(qname, 1, 1, 60, '10.0.0.%d' % (len(qname) % 250))], [], []))
+            with lock:
+                self.request.sendall(struct.pack('>H', len(data)) + data)
+
+    class Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address
+
+
+def connect_per_query(address, query):
+    sock = socket.create_connection(address, 2)
+    try:
+        sock.sendall(struct.pack('>H', len(query)) + query)
+        rfile = sock.makefile('rb')
+        return rfile.read(struct.unpack('>H', rfile.read(2))[0])
+    finally:
+        sock.close()
+
+
+def bench(label, DNSUtil, resolve):
+    errors = []
+
+    def worker(n):
+        for i in range(QUERIES):
+            qname = 'q%d-%d.example.com' % (n, i)
+            query = DNSUtil.pack_query(qname)
+            reply = resolve(query)
+            if not reply or reply[:2] != query[:2] or DNSUtil._reply_to_iplist(reply) != ['10.0.0.%d' % (len(qname) % 250)]:
+                errors.append(reply)
+    start_time = time.time()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('%-20s %6.0f queries/s, %d bad replies' % (label, THREADS*QUERIES / (time.time() - start_time), len(errors)))
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    DNSUtil = proxy.DNSUtil
+    address = serve_dns(DNSUtil)
+    bench('connect per query', DNSUtil, lambda query: connect_per_query(address, query))
+    bench('pooled pipelined', DNSUtil, lambda query: DNSUtil._tcp_resolve(address, query, 2))
+    print('pool stats %s, queries in flight per connection %s' % (dict(DNSUtil.tcp_pool.stats), [len(x) for x in DNSUtil.tcp_pool.connections[address]]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of DNSUtil wire format parsing against the old byte regex
+
+usage: bench_dnswire.py [proxy.py]
+
+Times the extraction of the A records of three replies: 8 plain answers, a
+CNAME chain, and answers with uncompressed names which the regex misses.  It
+also checks that pack_message(parse_message(reply)) round trips.
+"""
+
+import re
+import sys
+import timeit
+
+import benchutil
+
+COUNT = 20000
+
+
+def regex_iplist(data):
+    # the DNSUtil._reply_to_iplist of the baseline
+    return ['.'.join(str(x) for x in s) for s in re.findall(b'\xc0.\x00\x01\x00\x01.{6}(.{4})', data) if all(x <= 255 for x in s)]
+
+
+def replies(DNSUtil):
+    Record = DNSUtil.Record
+    plain = DNSUtil.Message(0x4321, 0x8180, [('www.google.com', 1, 1)], [Record('www.google.com', 1, 1, 299, '203.208.46.%d' % i) for i in range(131, 139)], [], [])
+    cname = DNSUtil.Message(0x1234, 0x8180, [('www.youtube.com', 1, 1)], [Record('www.youtube.com', 5, 1, 300, 'youtube-ui.l.google.com')] + [Record('youtube-ui.l.google.com', 1, 1, 120, '74.125.%d.%d' % (i, i*3)) for i in range(8)], [], [])
+    name = b'\x03www\x06google\x03com\x00'
+    uncompressed = bytes.fromhex('abcd81800001000200000000') + name + b'\x00\x01\x00\x01'
+    for ip in (b'\x08\x08\x08\x08', b'\x04\x04\x04\x04'):
+        uncompressed += name + b'\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04' + ip
+    return [('8 answers', DNSUtil.pack_message(plain)), ('cname + 8 answers', DNSUtil.pack_message(cname)), ('uncompressed names', uncompressed)]
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    DNSUtil = proxy.DNSUtil
+    for label, data in replies(DNSUtil):
+        message = DNSUtil.parse_message(data)
+        assert DNSUtil.parse_message(DNSUtil.pack_message(message)).answers == message.answers
+        regex_time = timeit.timeit(lambda: regex_iplist(data), number=COUNT) / COUNT
+        parser_time = timeit.timeit(lambda: DNSUtil._reply_to_iplist(data), number=COUNT) / COUNT
+        print('%-20s regex %6.2fus %-30r parser %6.2fus %r ttl=%r' % (label, regex_time*1e6, regex_iplist(data)[:2], parser_time*1e6, DNSUtil._reply_to_iplist(data)[:2], DNSUtil._reply_to_ttl(data)))
+
+
+if __name__ == '__main__':
+    main()
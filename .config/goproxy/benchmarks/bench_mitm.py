@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of MITM server side handshakes in do_CONNECT_AGENT
+
+usage: bench_mitm.py [proxy.py]
+
+Handshakes over socketpairs with the certificate CertUtil.get_cert gives a host
+without a shipped cert, once building a context from the PEM file per connection
+as ssl.wrap_socket(certfile=) did, and once with the context cached by
+CertUtil.get_ssl_context.  Each runs with and without a client resuming its last
+session; the client is held to TLS 1.2 so resumption shows in session_reused.
+"""
+
+import sys
+import ssl
+import time
+import socket
+import threading
+
+import benchutil
+
+COUNT = 400
+# the shipped certs are signed with md5 which current openssl refuses, use a host
+# getting CA.crt, or a fresh cert when pyopenssl is installed
+HOST = 'www.goproxy-bench.test'
+
+
+def bench(label, server_wrap, resume):
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    client_context.maximum_version = ssl.TLSVersion.TLSv1_2
+    session = None
+    resumed = 0
+    start_time = time.time()
+    for i in range(COUNT):
+        client, server = socket.socketpair()
+        client.settimeout(10)
+        thread = threading.Thread(target=lambda: server_wrap(server).close())
+        thread.start()
+        client = client_context.wrap_socket(client, server_hostname=HOST, session=session if resume else None)
+        resumed += client.session_reused
+        if resume:
+            session = client.session
+        thread.join()
+        client.close()
+    print('%-28s resume=%-5s %7.1f handshakes/s, %d/%d resumed' % (label, resume, COUNT / (time.time() - start_time), resumed, COUNT))
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    CertUtil = proxy.CertUtil
+
+    def per_connection(sock):
+        certfile = CertUtil.get_cert(HOST)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, certfile)
+        return context.wrap_socket(sock, server_side=True)
+
+    def cached(sock):
+        return CertUtil.get_ssl_context(HOST).wrap_socket(sock, server_side=True)
+    for label, server_wrap in (('context per connection', per_connection), ('cached SSLContext', cached)):
+        for resume in (False, True):
+            bench(label, server_wrap, resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of RangeFetch reordering
+
+usage: bench_rangefetch.py [proxy.py ...]
+
+RangeFetch downloads 24MB in 1MB ranges with 4 fetchlets from a stand-in
+urlfetch whose time to first byte varies from 10ms to 150ms per range, so
+ranges complete out of order.  Reports throughput, and how long the client
+side waited on gaps: the sleep() calls of the consumer thread for the old put
+back and sleep reorder loop, RangeBuffer.stall_time for the new one.
+"""
+
+import io
+import sys
+import time
+import random
+import hashlib
+import threading
+
+import benchutil
+
+LENGTH = 24*1024*1024
+RUNS = 3
+BODY = bytes(random.Random(0).getrandbits(8) for _ in range(4096)) * (LENGTH // 4096)
+
+
+class FakeResponse(object):
+    status = 206
+    app_status = 200
+
+    def __init__(self, start, end, first_byte_time):
+        self.fp = io.BytesIO(BODY[start:end+1])
+        self.first_byte_time = first_byte_time
+        self.headers = {'Content-Range': 'bytes %d-%d/%d' % (start, end, LENGTH), 'Content-Length': str(end-start+1)}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def read(self, size):
+        if self.first_byte_time:
+            time.sleep(self.first_byte_time)
+            self.first_byte_time = 0
+        # about 650MB/s per range at 32KB reads
+        time.sleep(0.00005)
+        return self.fp.read(size)
+
+    def close(self):
+        pass
+
+
+def urlfetch(method, url, headers, payload, fetchserver, **kwargs):
+    start, end = map(int, headers['Range'][6:].split('-'))
+    return FakeResponse(start, end, random.uniform(0.01, 0.15))
+
+
+class Sink(object):
+    def __init__(self):
+        self.header = True
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        if self.header:
+            self.header = False
+            return
+        self.md5.update(data)
+        self.size += len(data)
+
+
+def main():
+    consumer = threading.get_ident()
+    slept = [0]
+    sleep = time.sleep
+
+    def counting_sleep(seconds):
+        if threading.get_ident() == consumer:
+            slept[0] += seconds
+        sleep(seconds)
+    time.sleep = counting_sleep
+    expected = hashlib.md5(BODY).hexdigest()
+    for label, proxy in benchutil.load_proxies(sys.argv[1:]):
+        proxy.RangeFetch.urlfetch = staticmethod(urlfetch)
+        random.seed(1)
+        for run in range(RUNS):
+            sink = Sink()
+            rangefetch = proxy.RangeFetch(sink, FakeResponse(0, 1024*1024-1, 0), 'GET', 'http://bench.test/', {}, b'', ['http://bench.appspot.com/2?'], '', maxsize=1024*1024, bufsize=32768, threads=4)
+            slept[0] = 0
+            start_time = time.time()
+            rangefetch.fetch()
+            elapsed = time.time() - start_time
+            assert sink.size == LENGTH and sink.md5.hexdigest() == expected, 'corrupted body'
+            stall_time = getattr(getattr(rangefetch, '_data_buffer', None), 'stall_time', slept[0])
+            print('%-24s %6.1f MB/s, consumer waited %.2fs' % (label, LENGTH / elapsed / 1e6, stall_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of HTTPUtil.relay for response bodies
+
+usage: bench_relay.py [proxy.py]
+
+Relays a 256MB body from a local upstream stand-in to a local sink three ways:
+the old read(8192)/sendall loop, the relay copy path through pooled buffers
+(forced by a callback), and the relay splice path.  Reports MB/s and buffer
+allocations per MB, which are bytes objects read for the old loop and pool
+misses for relay.
+"""
+
+import sys
+import time
+import socket
+import threading
+import http.client
+
+import benchutil
+
+SIZE = 256*1024*1024
+CHUNK = b'x' * (1 << 20)
+
+
+def serve(handler):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    def loop():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=handler, args=(sock,), daemon=True).start()
+    threading.Thread(target=loop, daemon=True).start()
+    return listener.getsockname()
+
+
+def upstream(sock):
+    sock.recv(65536)
+    sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % SIZE)
+    for i in range(SIZE // len(CHUNK)):
+        sock.sendall(CHUNK)
+    sock.close()
+
+
+def sink(sock):
+    buf = bytearray(1 << 20)
+    while sock.recv_into(buf):
+        pass
+    sock.close()
+
+
+def bench(label, http_util, upstream_address, sink_address, mode):
+    source = socket.create_connection(upstream_address, 30)
+    source.sendall(b'GET / HTTP/1.1\r\n\r\n')
+    response = http.client.HTTPResponse(source)
+    response.begin()
+    dest = socket.create_connection(sink_address, 30)
+    http_util.buffer_pool.stats.clear()
+    allocations = 0
+    start_time = time.time()
+    if mode == 'old':
+        while True:
+            data = response.read(8192)
+            if not data:
+                break
+            allocations += 1
+            dest.sendall(data)
+    else:
+        # a callback keeps relay off the zero copy paths
+        http_util.relay(response, dest, callback=(lambda data: None) if mode == 'copy' else None)
+        allocations = http_util.buffer_pool.stats['alloc']
+    elapsed = time.time() - start_time
+    dest.close()
+    source.close()
+    print('%-24s %7.1f MB/s, %8.3f buffer allocations/MB' % (label, SIZE / elapsed / 1e6, allocations / (SIZE / 1e6)))
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    upstream_address = serve(upstream)
+    sink_address = serve(sink)
+    for label, mode in (('old read(8192)/sendall', 'old'), ('relay copy', 'copy'), ('relay splice', 'splice')):
+        bench(label, proxy.http_util, upstream_address, sink_address, mode)
+    print('relay paths taken %s' % dict(proxy.http_util.relay_stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Benchmark of forward_socket tunnels
+
+usage: bench_tunnel.py [proxy.py]
+
+Pumps 1GB through 1 and 8 loopback tunnels, forwarded by the select loop of a
+thread per tunnel, by a TunnelMultiplexer copying through userspace buffers,
+and by a TunnelMultiplexer moving the data with os.splice.  The pump and sink
+run in this process too, so they cap the numbers.
+"""
+
+import sys
+import time
+import socket
+import threading
+
+import benchutil
+
+SIZE = 1024*1024*1024
+CHUNK = b'x' * (1 << 20)
+
+
+def listen():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+    return listener
+
+
+def drain(sock, received):
+    buf = bytearray(1 << 20)
+    size = 0
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        size += n
+    sock.close()
+    received.append(size)
+
+
+def pump(sock, size):
+    for i in range(size // len(CHUNK)):
+        sock.sendall(CHUNK)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def bench(proxy, mode, tunnels):
+    upstream, local = listen(), listen()
+    http_util = proxy.HTTPUtil()
+    if mode != 'select':
+        http_util.tunnel_multiplexer = proxy.TunnelMultiplexer(2, 256*1024, splice=(mode == 'splice'))
+    clients = []
+    sinks = []
+    received = []
+    for i in range(tunnels):
+        client = socket.create_connection(local.getsockname())
+        remote = socket.create_connection(upstream.getsockname())
+        if mode == 'select':
+            threading.Thread(target=http_util.forward_socket, args=(local.accept()[0], remote), kwargs={'bufsize': 65536}, daemon=True).start()
+        else:
+            http_util.forward_socket(local.accept()[0], remote)
+        sinks.append(threading.Thread(target=drain, args=(upstream.accept()[0], received)))
+        clients.append(client)
+    start_time = time.time()
+    pumps = [threading.Thread(target=pump, args=(x, SIZE // tunnels)) for x in clients]
+    for thread in pumps + sinks:
+        thread.start()
+    for thread in pumps + sinks:
+        thread.join()
+    elapsed = time.time() - start_time
+    for sock in clients + [upstream, local]:
+        sock.close()
+    assert sum(received) == SIZE, 'lost %d bytes' % (SIZE - sum(received))
+    print('%-7s tunnels=%-2d %7.0f MB/s' % (mode, tunnels, SIZE / elapsed / 1e6))
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    for tunnels in (1, 8):
+        for mode in ('select', 'copy', 'splice'):
+            bench(proxy, mode, tunnels)
+
+
+if __name__ == '__main__':
+    main()
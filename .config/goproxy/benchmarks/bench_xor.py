@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Correctness checks and micro benchmark of XORCodec
+
+usage: bench_xor.py [proxy.py]
+
+Checks XORCodec against a per-byte reference for 1 to 16 byte keys at random
+chunk boundaries, both returned and written back into a buffer, a wrapped PAAS
+style response read and relayed, and forward_socket bitmask tunnels.  Then
+times 1MB chunks against the old per-byte generator.
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import socket
+import threading
+import http.client
+
+import benchutil
+
+
+def reference(data, key, offset=0):
+    return bytes(b ^ key[(i + offset) % len(key)] for i, b in enumerate(data))
+
+
+def check_codec(XORCodec):
+    for key in (b'g', b'ab', b'goagent', bytes(range(1, 17)), 0x5a, 'x'):
+        key_bytes = bytes([key]) if isinstance(key, int) else key.encode() if isinstance(key, str) else key
+        data = os.urandom(100003)
+        expected = reference(data, key_bytes)
+        codec = XORCodec(key)
+        output = []
+        pos = 0
+        while pos < len(data):
+            size = random.randint(0, 5000)
+            output.append(codec.transform(data[pos:pos+size]))
+            pos += size
+        assert b''.join(output) == expected, 'transform key=%r' % key
+        codec = XORCodec(key)
+        buf = bytearray(data)
+        view = memoryview(buf)
+        pos = 0
+        while pos < len(buf):
+            size = min(random.randint(1, 7000), len(buf) - pos)
+            codec.transform_into(view[pos:pos+size], size)
+            pos += size
+        assert bytes(buf) == expected, 'transform_into key=%r' % key
+    print('codec matches the per-byte reference: ok')
+
+
+class FakeSocket(object):
+    def __init__(self, data):
+        self.fp = io.BytesIO(data)
+
+    def makefile(self, *args, **kwargs):
+        return self.fp
+
+
+def check_response(proxy):
+    body = os.urandom(300000)
+    raw = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + reference(body, b'k')
+    response = http.client.HTTPResponse(FakeSocket(raw))
+    response.begin()
+    proxy.XORCodec('k').wrap(response)
+    assert response.read(1000) + response.read() == body, 'wrapped read'
+    response = http.client.HTTPResponse(FakeSocket(raw))
+    response.begin()
+    proxy.XORCodec('k').wrap(response)
+    left, right = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(iter(lambda: right.recv(65536), b'')))
+    reader.start()
+    proxy.http_util.relay(response, left)
+    left.close()
+    reader.join()
+    right.close()
+    assert b''.join(received) == body, 'wrapped relay'
+    print('wrapped response read and relayed by readinto: ok')
+
+
+def check_bitmask(proxy):
+    for multiplexer in (None, proxy.TunnelMultiplexer(1)):
+        proxy.http_util.tunnel_multiplexer = multiplexer
+        client, local = socket.socketpair()
+        remote, server = socket.socketpair()
+        threading.Thread(target=proxy.http_util.forward_socket, args=(local, remote), kwargs={'bitmask': 0x33, 'timeout': 5, 'tick': 1}, daemon=True).start()
+        client.sendall(b'hello')
+        assert server.recv(16) == reference(b'hello', b'\x33'), 'bitmask upstream'
+        server.sendall(reference(b'world', b'\x33'))
+        assert client.recv(16) == b'world', 'bitmask downstream'
+        client.close()
+        server.close()
+    proxy.http_util.tunnel_multiplexer = None
+    print('forward_socket bitmask over select loop and multiplexer: ok')
+
+
+def bench(label, function, count):
+    start_time = time.perf_counter()
+    for i in range(count):
+        function()
+    print('%-30s %7.1f MB/s' % (label, count / (time.perf_counter() - start_time)))
+
+
+def main():
+    proxy = benchutil.load_proxy(sys.argv[1] if sys.argv[1:] else None)
+    check_codec(proxy.XORCodec)
+    check_response(proxy)
+    check_bitmask(proxy)
+    data = os.urandom(1 << 20)
+    buf = bytearray(data)
+    view = memoryview(buf)
+    ordchar = ord('g')
+    bench('old generator, 1 byte key', lambda: bytes(c ^ ordchar for c in data), 3)
+    bench('translate, 1 byte key', lambda: proxy.XORCodec(b'g').transform(data), 200)
+    codec = proxy.XORCodec(b'g')
+    bench('translate into buffer', lambda: codec.transform_into(view, len(buf)), 200)
+    bench('wide int, 7 byte key', lambda: proxy.XORCodec(b'goagent').transform(data), 100)
+    codec = proxy.XORCodec(b'goagent')
+    bench('wide int into buffer', lambda: codec.transform_into(view, len(buf)), 100)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""Shared helpers of the goproxy benchmarks
+
+proxy.py reads the proxy.ini next to it and needs an appid to import, so every
+proxy.py under test is imported from a scratch directory holding a copy of
+proxy.ini with a placeholder appid.  A benchmark given older proxy.py files,
+e.g. from `git show <rev>:.config/goproxy/proxy.py > /tmp/proxy_old.py`, runs
+against each of them in turn.
+"""
+
+import sys
+import os
+import re
+import atexit
+import shutil
+import tempfile
+import importlib.util
+
+GOPROXY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_proxy(filename=None, name='proxy', quiet=True):
+    """import filename, the proxy.py of this tree by default, as module name"""
+    filename = os.path.abspath(filename or os.path.join(GOPROXY_DIR, 'proxy.py'))
+    directory = tempfile.mkdtemp(prefix='goproxy-bench-')
+    atexit.register(shutil.rmtree, directory, True)
+    shutil.copy(filename, os.path.join(directory, name + '.py'))
+    with open(os.path.join(GOPROXY_DIR, 'proxy.ini'), 'rb') as fp:
+        config = re.sub(br'(?m)^appid = *(\r?)$', br'appid = benchmark\1', fp.read())
+    with open(os.path.join(directory, name + '.ini'), 'wb') as fp:
+        fp.write(config)
+    # CA.crt, certs and cacert.pem are opened relative to the working directory
+    os.chdir(GOPROXY_DIR)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    if quiet:
+        module.logging.info = module.logging.warning = module.logging.error = module.logging.dummy
+    return module
+
+
+def load_proxies(filenames):
+    """import every proxy.py of filenames, the one of this tree when none given, return [(label, module)]"""
+    return [(filename or 'proxy.py', load_proxy(filename, 'proxy%d' % i)) for i, filename in enumerate(filenames or [None])]
@@ -40,29 +40,42 @@ import struct
 import collections
 import zlib
 import functools
+import itertools
 import re
 import io
 import copy
 import fnmatch
+import ipaddress
 import traceback
 import random
 import base64
+import json
 import hashlib
 import queue
+import tempfile
+import heapq
+import bisect
+import mmap
 import threading
 import socket
 import ssl
 import select
+import selectors
 import socketserver
 import http.server
 import http.client
 import urllib.request
 import urllib.parse
+import email.utils
 import configparser
 try:
     import ctypes
 except ImportError:
     ctypes = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 try:
     import OpenSSL
 except ImportError:
@@ -152,6 +165,12 @@ class CertUtil(object):
     ca_keyfile = 'CA.crt'
     ca_certdir = 'certs'
     ca_lock = threading.Lock()
+    # certfiles known to exist, so get_cert does not stat them again
+    certfiles = set()
+    # wildcard commonname -> server side SSLContext, in lru order
+    ssl_contexts = collections.OrderedDict()
+    ssl_context_lock = threading.Lock()
+    max_ssl_contexts = 256
 
     @staticmethod
     def create_ca():
@@ -239,20 +258,50 @@ class CertUtil(object):
             fp.write(OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, pkey))
         return certfile
 
+    @staticmethod
+    def get_commonname(host):
+        """return the wildcard commonname, like .google.com, shared by the certificate of host"""
+        if host.count('.') >= 2 and len(host.split('.')[-2]) > 4:
+            return '.'+host.partition('.')[-1]
+        return host
+
     @staticmethod
     def get_cert(commonname, sans=[]):
-        if commonname.count('.') >= 2 and len(commonname.split('.')[-2]) > 4:
-            commonname = '.'+commonname.partition('.')[-1]
+        commonname = CertUtil.get_commonname(commonname)
         certfile = os.path.join(CertUtil.ca_certdir, commonname + '.crt')
-        if os.path.exists(certfile):
+        if certfile in CertUtil.certfiles:
+            return certfile
+        elif os.path.exists(certfile):
+            CertUtil.certfiles.add(certfile)
             return certfile
         elif OpenSSL is None:
             return CertUtil.ca_keyfile
         else:
             with CertUtil.ca_lock:
-                if os.path.exists(certfile):
-                    return certfile
-                return CertUtil._get_cert(commonname, sans)
+                if not os.path.exists(certfile):
+                    certfile = CertUtil._get_cert(commonname, sans)
+                CertUtil.certfiles.add(certfile)
+                return certfile
+
+    @staticmethod
+    def get_ssl_context(host):
+        """return a server side SSLContext with the certificate of host, built once per wildcard commonname"""
+        commonname = CertUtil.get_commonname(host)
+        with CertUtil.ssl_context_lock:
+            context = CertUtil.ssl_contexts.get(commonname)
+            if context:
+                CertUtil.ssl_contexts.move_to_end(commonname)
+                return context
+        certfile = CertUtil.get_cert(commonname)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # a reused context keeps its session ticket key, so browsers resume instead of a full handshake
+        context.options &= ~ssl.OP_NO_TICKET
+        context.load_cert_chain(certfile)
+        with CertUtil.ssl_context_lock:
+            CertUtil.ssl_contexts[commonname] = context
+            while len(CertUtil.ssl_contexts) > CertUtil.max_ssl_contexts:
+                CertUtil.ssl_contexts.popitem(last=False)
+        return context
 
     @staticmethod
     def import_ca(certfile):
@@ -342,6 +391,221 @@ class ProxyUtil(object):
         return proxies.get('https') or proxies.get('http') or {}
 
 
+class ConnectionScoreboard(object):
+    """Connection Quality Scoreboard, keeps ewma/p90 latency, failure rate and last seen time of each address"""
+
+    alpha = 0.3
+    max_samples = 16
+    max_size = 2048
+    max_age = 7 * 24 * 60 * 60
+    unknown_score = 1.0
+
+    def __init__(self, failure_penalty=16, max_size=0):
+        self.failure_penalty = failure_penalty
+        self.max_size = max_size or self.__class__.max_size
+        # address -> [ewma latency, ewma failure rate, last seen time, recent samples]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _update(self, addr, elapsed, failed):
+        with self.lock:
+            entry = self.entries.pop(addr, None)
+            if entry is None:
+                entry = [elapsed, float(failed), 0, collections.deque(maxlen=self.max_samples)]
+            else:
+                entry[0] += self.alpha * (elapsed - entry[0])
+                entry[1] += self.alpha * (failed - entry[1])
+            entry[2] = time.time()
+            entry[3].append(elapsed)
+            self.entries[addr] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def record(self, addr, elapsed):
+        self._update(addr, elapsed, 0)
+
+    def record_failure(self, addr):
+        self._update(addr, self.failure_penalty, 1)
+
+    def get(self, addr, default=None):
+        """return p90 latency of recent samples plus penalty of recent failure rate, unknown address returns default"""
+        with self.lock:
+            entry = self.entries.get(addr)
+            if entry is None:
+                return default
+            samples = sorted(entry[3])
+            return samples[int(len(samples) * 0.9)] + entry[1] * self.failure_penalty
+
+    def __getitem__(self, addr):
+        return self.get(addr, self.unknown_score)
+
+    def __contains__(self, addr):
+        return addr in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def dump(self):
+        with self.lock:
+            return [[addr[0], addr[1], ewma, failure_rate, last_seen, list(samples)] for addr, (ewma, failure_rate, last_seen, samples) in self.entries.items()]
+
+    def load(self, items):
+        now = time.time()
+        with self.lock:
+            for host, port, ewma, failure_rate, last_seen, samples in sorted(items, key=lambda x: x[4]):
+                if now - last_seen < self.max_age:
+                    self.entries[(host, port)] = [ewma, failure_rate, last_seen, collections.deque(samples, maxlen=self.max_samples)]
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class DNSTCPConnection(object):
+    """Pipelined DNS over TCP Connection"""
+
+    def __init__(self, addr, timeout=None, max_inflight=32):
+        self.addr = addr
+        self.sock = socket.create_connection(addr, timeout=timeout)
+        self.sock.settimeout(None)
+        self.rfile = self.sock.makefile('rb', 8192)
+        self.max_inflight = max_inflight
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+        self.waiters = {}
+        self.lock = threading.Lock()
+        # sends only, a slow send never holds up the reader matching replies under lock
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.last_active = time.time()
+        threading._start_new_thread(self._read_replies, ())
+
+    def _read_replies(self):
+        try:
+            while not self.closed:
+                data = self.rfile.read(2)
+                if len(data) < 2:
+                    break
+                data = self.rfile.read(struct.unpack('>H', data)[0])
+                self.last_active = time.time()
+                with self.lock:
+                    waiter = self.waiters.get(data[:2])
+                if waiter:
+                    waiter[1] = data
+                    waiter[0].set()
+        except (OSError, ValueError) as e:
+            if not self.closed:
+                logging.debug('DNSTCPConnection(%r) read error: %r', self.addr, e)
+        finally:
+            self.close()
+            # the rfile holds a reference of the socket fd, only this thread may close it while reading
+            self.rfile.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            waiters, self.waiters = self.waiters, {}
+        for waiter in waiters.values():
+            waiter[0].set()
+        try:
+            # wake up the reader blocked in rfile.read, close alone leaves the fd open while rfile refers to it
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def query(self, query, timeout=None):
+        """send query with a connection unique id, return the reply with the original id or None when timed out"""
+        if not self.inflight.acquire(timeout=timeout):
+            return None
+        try:
+            waiter = [threading.Event(), None]
+            with self.lock:
+                if self.closed:
+                    raise socket.error('DNSTCPConnection(%r) is closed' % (self.addr,))
+                qid = os.urandom(2)
+                while qid in self.waiters:
+                    qid = os.urandom(2)
+                self.waiters[qid] = waiter
+            # send under the write lock so pipelined messages never interleave
+            with self.write_lock:
+                self.sock.sendall(struct.pack('>H', len(query)) + qid + query[2:])
+            self.last_active = time.time()
+            waiter[0].wait(timeout)
+            with self.lock:
+                self.waiters.pop(qid, None)
+            if waiter[1] is None and self.closed:
+                raise socket.error('DNSTCPConnection(%r) closed by peer' % (self.addr,))
+            return query[:2] + waiter[1][2:] if waiter[1] else None
+        except OSError:
+            self.close()
+            raise
+        finally:
+            self.inflight.release()
+
+
+class DNSTCPPool(object):
+    """Persistent DNS over TCP Connection Pool"""
+
+    max_connections = 2
+    max_inflight = 32
+    max_idle_time = 30
+
+    def __init__(self, max_connections=0, max_inflight=0, max_idle_time=0):
+        self.max_connections = max_connections or self.__class__.max_connections
+        self.max_inflight = max_inflight or self.__class__.max_inflight
+        self.max_idle_time = max_idle_time or self.__class__.max_idle_time
+        self.connections = collections.defaultdict(list)
+        self.connecting = collections.Counter()
+        self.condition = threading.Condition()
+        self.stats = collections.Counter()
+
+    def _get_connection(self, addr, timeout=None):
+        now = time.time()
+        with self.condition:
+            connections = self.connections[addr]
+            for conn in connections[:]:
+                if conn.closed or (not len(conn) and now - conn.last_active > self.max_idle_time):
+                    # upstreams drop idle connections silently, reconnect instead of timing out on them
+                    connections.remove(conn)
+                    conn.close()
+                    self.stats['reconnect'] += 1
+            while not connections and self.connecting[addr] >= self.max_connections:
+                if not self.condition.wait(timeout):
+                    raise socket.timeout('DNSTCPPool connect to %r timed out' % (addr,))
+            conn = min(connections, key=len) if connections else None
+            if conn is not None and (len(conn) < conn.max_inflight or len(connections) + self.connecting[addr] >= self.max_connections):
+                self.stats['reuse'] += 1
+                return conn
+            self.connecting[addr] += 1
+        try:
+            conn = DNSTCPConnection(addr, timeout, self.max_inflight)
+            with self.condition:
+                self.connections[addr].append(conn)
+                self.stats['connect'] += 1
+            return conn
+        finally:
+            with self.condition:
+                self.connecting[addr] -= 1
+                self.condition.notify_all()
+
+    def query(self, addr, query, timeout=None):
+        for i in range(2):
+            conn = self._get_connection(addr, timeout)
+            try:
+                return conn.query(query, timeout)
+            except OSError:
+                # connection may be closed by peer between queries, retry once on a fresh one
+                if i:
+                    raise
+
+    def close(self):
+        with self.condition:
+            connections, self.connections = self.connections, collections.defaultdict(list)
+        for conn in itertools.chain.from_iterable(connections.values()):
+            conn.close()
+
+
 class DNSUtil(object):
     """
     http://gfwrev.blogspot.com/2009/11/gfwdns.html
@@ -365,76 +629,421 @@ class DNSUtil(object):
                     '72.14.205.104', '72.14.205.99', '78.16.49.15', '8.7.198.45', '93.46.8.89',
                     ])
     max_retry = 3
-    max_wait = 3
+    default_timeout = 4
+    hedge_delay = 0.3
+    min_hedge_delay = 0.05
+    max_hedge_delay = 1.0
+    upstream_time = ConnectionScoreboard(failure_penalty=default_timeout)
+    tcp_pool = DNSTCPPool()
+
+    TYPE_A = 1
+    TYPE_NS = 2
+    TYPE_CNAME = 5
+    TYPE_SOA = 6
+    TYPE_PTR = 12
+    TYPE_MX = 15
+    TYPE_AAAA = 28
+    TYPE_OPT = 41
+    CLASS_IN = 1
+    name_types = frozenset([TYPE_NS, TYPE_CNAME, TYPE_PTR])
+    header_struct = struct.Struct('>HHHHHH')
+    question_struct = struct.Struct('>HH')
+    record_struct = struct.Struct('>HHIH')
+    soa_struct = struct.Struct('>IIIII')
+    Message = collections.namedtuple('DNSMessage', 'id flags questions answers authorities additionals')
+    Record = collections.namedtuple('DNSRecord', 'name type klass ttl data')
+
+    @staticmethod
+    def _unpack_name(data, offset):
+        labels = []
+        end = 0
+        jumps = 0
+        while 1:
+            length = data[offset]
+            if length >= 0xc0:
+                # compression pointer, name continues at another offset
+                jumps += 1
+                if jumps > 32:
+                    raise ValueError('dns name compression loop at offset %d' % offset)
+                if not end:
+                    end = offset + 2
+                offset = ((length & 0x3f) << 8) | data[offset+1]
+            elif length:
+                labels.append(data[offset+1:offset+1+length])
+                offset += 1 + length
+            else:
+                return b'.'.join(labels).decode('latin-1'), end or offset + 1
+
+    @staticmethod
+    def _pack_name(buf, name, offsets):
+        labels = [x for x in name.split('.') if x]
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:]).lower()
+            if suffix in offsets:
+                buf += struct.pack('>H', 0xc000 | offsets[suffix])
+                return
+            if len(buf) < 0x3fff:
+                offsets[suffix] = len(buf)
+            label = labels[i].encode('latin-1')
+            buf.append(len(label))
+            buf += label
+        buf.append(0)
+
+    @staticmethod
+    def parse_message(data):
+        """parse dns message to DNSMessage, A/AAAA/NS/CNAME/PTR/MX/SOA record data are decoded, raise ValueError on malformed data"""
+        try:
+            qid, flags, qdcount, ancount, nscount, arcount = DNSUtil.header_struct.unpack_from(data)
+            offset = 12
+            questions = []
+            for i in range(qdcount):
+                qname, offset = DNSUtil._unpack_name(data, offset)
+                questions.append((qname,) + DNSUtil.question_struct.unpack_from(data, offset))
+                offset += 4
+            sections = []
+            for count in (ancount, nscount, arcount):
+                records = []
+                for i in range(count):
+                    name, offset = DNSUtil._unpack_name(data, offset)
+                    rtype, rclass, ttl, rdlength = DNSUtil.record_struct.unpack_from(data, offset)
+                    offset += 10
+                    rdata = data[offset:offset+rdlength]
+                    if len(rdata) < rdlength:
+                        raise ValueError('dns record data truncated')
+                    if rtype == DNSUtil.TYPE_A:
+                        rdata = socket.inet_ntop(socket.AF_INET, rdata)
+                    elif rtype == DNSUtil.TYPE_AAAA:
+                        rdata = socket.inet_ntop(socket.AF_INET6, rdata)
+                    elif rtype in DNSUtil.name_types:
+                        rdata = DNSUtil._unpack_name(data, offset)[0]
+                    elif rtype == DNSUtil.TYPE_MX:
+                        rdata = (struct.unpack_from('>H', data, offset)[0], DNSUtil._unpack_name(data, offset+2)[0])
+                    elif rtype == DNSUtil.TYPE_SOA:
+                        mname, rname_offset = DNSUtil._unpack_name(data, offset)
+                        rname, numbers_offset = DNSUtil._unpack_name(data, rname_offset)
+                        rdata = (mname, rname) + DNSUtil.soa_struct.unpack_from(data, numbers_offset)
+                    offset += rdlength
+                    records.append(DNSUtil.Record(name, rtype, rclass, ttl, rdata))
+                sections.append(records)
+        except (IndexError, struct.error, OSError) as e:
+            raise ValueError('malformed dns message: %r' % e)
+        return DNSUtil.Message(qid, flags, questions, *sections)
+
+    @staticmethod
+    def pack_message(message):
+        """pack DNSMessage to bytes, names are compressed"""
+        buf = bytearray(DNSUtil.header_struct.pack(message.id, message.flags, len(message.questions), len(message.answers), len(message.authorities), len(message.additionals)))
+        offsets = {}
+        for qname, qtype, qclass in message.questions:
+            DNSUtil._pack_name(buf, qname, offsets)
+            buf += DNSUtil.question_struct.pack(qtype, qclass)
+        for record in itertools.chain(message.answers, message.authorities, message.additionals):
+            DNSUtil._pack_name(buf, record.name, offsets)
+            offset = len(buf)
+            buf += DNSUtil.record_struct.pack(record.type, record.klass, record.ttl, 0)
+            if record.type == DNSUtil.TYPE_A:
+                buf += socket.inet_pton(socket.AF_INET, record.data)
+            elif record.type == DNSUtil.TYPE_AAAA:
+                buf += socket.inet_pton(socket.AF_INET6, record.data)
+            elif record.type in DNSUtil.name_types:
+                DNSUtil._pack_name(buf, record.data, offsets)
+            elif record.type == DNSUtil.TYPE_MX:
+                buf += struct.pack('>H', record.data[0])
+                DNSUtil._pack_name(buf, record.data[1], offsets)
+            elif record.type == DNSUtil.TYPE_SOA:
+                DNSUtil._pack_name(buf, record.data[0], offsets)
+                DNSUtil._pack_name(buf, record.data[1], offsets)
+                buf += DNSUtil.soa_struct.pack(*record.data[2:])
+            else:
+                buf += record.data
+            struct.pack_into('>H', buf, offset+8, len(buf)-offset-10)
+        return bytes(buf)
+
+    @staticmethod
+    def pack_query(qname, qtype=TYPE_A, qid=None):
+        qid = struct.unpack('>H', os.urandom(2))[0] if qid is None else qid
+        return DNSUtil.pack_message(DNSUtil.Message(qid, 0x0100, [(qname, qtype, DNSUtil.CLASS_IN)], [], [], []))
+
+    @staticmethod
+    def _skip_name(data, offset):
+        while 1:
+            length = data[offset]
+            if length >= 0xc0:
+                return offset + 2
+            elif length:
+                offset += 1 + length
+            else:
+                return offset + 1
+
+    @staticmethod
+    def _answers_to_iplist(data):
+        """fast path of parse_message(data).answers, only A/AAAA records are decoded, raise ValueError on malformed data"""
+        try:
+            qdcount, ancount = DNSUtil.question_struct.unpack_from(data, 4)
+            offset = 12
+            for i in range(qdcount):
+                offset = DNSUtil._skip_name(data, offset) + 4
+            iplist = []
+            for i in range(ancount):
+                offset = DNSUtil._skip_name(data, offset)
+                rtype, _, _, rdlength = DNSUtil.record_struct.unpack_from(data, offset)
+                offset += 10
+                if rtype == DNSUtil.TYPE_A:
+                    iplist.append(socket.inet_ntop(socket.AF_INET, data[offset:offset+rdlength]))
+                elif rtype == DNSUtil.TYPE_AAAA:
+                    iplist.append(socket.inet_ntop(socket.AF_INET6, data[offset:offset+rdlength]))
+                offset += rdlength
+            return iplist
+        except (IndexError, struct.error, OSError) as e:
+            raise ValueError('malformed dns message: %r' % e)
 
     @staticmethod
     def _reply_to_iplist(data):
-        iplist = ['.'.join(str(x) for x in s) for s in re.findall(b'\xc0.\x00\x01\x00\x01.{6}(.{4})', data) if all(x <= 255 for x in s)]
-        return iplist
+        try:
+            return DNSUtil._answers_to_iplist(data)
+        except ValueError:
+            return []
+
+    @staticmethod
+    def _reply_to_ttl(data):
+        try:
+            message = DNSUtil.parse_message(data)
+        except ValueError:
+            return None
+        return min([x.ttl for x in message.answers] or [None])
 
     @staticmethod
     def is_bad_reply(data):
-        iplist = ['.'.join(str(x) for x in s) for s in re.findall(b'\xc0.\x00\x01\x00\x01.{6}(.{4})', data) if all(x <= 255 for x in s)]
-        iplist += ['.'.join(str(x) for x in s) for s in re.findall(b'\x00\x01\x00\x01.{6}(.{4})', data) if all(x <= 255 for x in s)]
-        return any(x in DNSUtil.blacklist for x in iplist)
+        try:
+            return any(x in DNSUtil.blacklist for x in DNSUtil._answers_to_iplist(data))
+        except ValueError:
+            return True
 
     @staticmethod
-    def _remote_resolve(dnsserver, qname, timeout=None):
-        if isinstance(dnsserver, tuple):
-            dnsserver, port = dnsserver
-        else:
-            port = 53
-        for i in range(DNSUtil.max_retry):
-            data = os.urandom(2)
-            data += b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
-            data += ''.join(chr(len(x))+x for x in qname.split('.')).encode('ascii')
-            data += b'\x00\x00\x01\x00\x01'
-            address_family = socket.AF_INET6 if ':' in dnsserver else socket.AF_INET
-            sock = None
-            try:
-                if i < DNSUtil.max_retry-1:
-                    # UDP mode query
-                    sock = socket.socket(family=address_family, type=socket.SOCK_DGRAM)
-                    sock.settimeout(timeout)
-                    sock.sendto(data, (dnsserver, port))
-                    for i in range(DNSUtil.max_wait):
-                        data = sock.recv(512)
-                        if data and not DNSUtil.is_bad_reply(data):
-                            return data[2:]
-                        else:
-                            logging.warning('DNSUtil._remote_resolve(dnsserver=%r, %r) return poisoned udp data=%r', qname, dnsserver, data)
-                else:
-                    # TCP mode query
-                    sock = socket.socket(family=address_family, type=socket.SOCK_STREAM)
-                    sock.settimeout(timeout)
-                    sock.connect((dnsserver, port))
-                    data = struct.pack('>h', len(data)) + data
-                    sock.send(data)
-                    rfile = sock.makefile('rb', 512)
-                    data = rfile.read(2)
-                    if not data:
-                        logging.warning('DNSUtil._remote_resolve(dnsserver=%r, %r) return bad tcp header data=%r', qname, dnsserver, data)
+    def _dnsserver_address(dnsserver):
+        return dnsserver if isinstance(dnsserver, tuple) else (dnsserver, 53)
+
+    @staticmethod
+    def _hedge_delay(addr):
+        return min(max(DNSUtil.upstream_time.get(addr, DNSUtil.hedge_delay), DNSUtil.min_hedge_delay), DNSUtil.max_hedge_delay)
+
+    @staticmethod
+    def _udp_resolve(addrs, query, timeout=None):
+        """hedged UDP query, query addrs one by one when the last one has no good reply in its hedge delay, return first reply which is not poisoned"""
+        deadline = time.time() + (timeout or DNSUtil.default_timeout)
+        selector = selectors.DefaultSelector()
+        pending = collections.deque(addrs)
+        queried = {}
+        next_query_time = 0
+        try:
+            while pending or queried:
+                now = time.time()
+                if now >= deadline:
+                    break
+                if pending and now >= next_query_time:
+                    addr = pending.popleft()
+                    sock = socket.socket(family=socket.AF_INET6 if ':' in addr[0] else socket.AF_INET, type=socket.SOCK_DGRAM)
+                    try:
+                        sock.sendto(query, addr)
+                    except OSError as e:
+                        logging.warning('DNSUtil._udp_resolve sendto %r failed: %s', addr, e)
+                        DNSUtil.upstream_time.record_failure(addr)
+                        sock.close()
                         continue
-                    data = rfile.read(struct.unpack('>h', data)[0])
-                    if data and not DNSUtil.is_bad_reply(data):
-                        return data[2:]
-                    else:
-                        logging.warning('DNSUtil._remote_resolve(dnsserver=%r, %r) return bad tcp data=%r', qname, dnsserver, data)
-            except OSError as e:
-                if e.args[0] in (errno.ETIMEDOUT, 'timed out'):
+                    queried[sock] = (addr, now)
+                    selector.register(sock, selectors.EVENT_READ)
+                    next_query_time = now + DNSUtil._hedge_delay(addr)
                     continue
-            except Exception as e:
-                raise
-            finally:
-                if sock:
-                    sock.close()
+                wait = deadline - now
+                if pending:
+                    wait = min(wait, next_query_time - now)
+                for key, _ in selector.select(max(wait, 0)):
+                    sock = key.fileobj
+                    addr, query_time = queried[sock]
+                    try:
+                        data = sock.recv(512)
+                    except OSError as e:
+                        logging.warning('DNSUtil._udp_resolve recv %r failed: %s', addr, e)
+                        DNSUtil.upstream_time.record_failure(addr)
+                        selector.unregister(sock)
+                        del queried[sock]
+                        sock.close()
+                        next_query_time = 0
+                        continue
+                    if data[:2] != query[:2]:
+                        continue
+                    if DNSUtil.is_bad_reply(data):
+                        # poisoned reply comes first, keep waiting for the real one and query the next dnsserver now
+                        logging.warning('DNSUtil._udp_resolve(dnsserver=%r) return poisoned udp data=%r', addr, data)
+                        next_query_time = 0
+                        continue
+                    DNSUtil.upstream_time.record(addr, time.time() - query_time)
+                    return data
+            for addr, _ in queried.values():
+                DNSUtil.upstream_time.record_failure(addr)
+        finally:
+            for sock in queried:
+                sock.close()
+            selector.close()
+
+    @staticmethod
+    def _tcp_resolve(addr, query, timeout=None):
+        data = DNSUtil.tcp_pool.query(addr, query, timeout)
+        if data and not DNSUtil.is_bad_reply(data):
+            return data
+        else:
+            logging.warning('DNSUtil._tcp_resolve(dnsserver=%r) return bad tcp data=%r', addr, data)
+
+    @staticmethod
+    def _remote_resolve(dnsserver, qname, timeout=None, qtype=TYPE_A):
+        """query qname of qtype from dnsserver or a list of dnsservers, return the whole reply message which is not poisoned"""
+        addrs = [DNSUtil._dnsserver_address(x) for x in (dnsserver if isinstance(dnsserver, list) else [dnsserver])]
+        addrs.sort(key=DNSUtil.upstream_time.__getitem__)
+        for i in range(DNSUtil.max_retry):
+            query = DNSUtil.pack_query(qname, qtype)
+            if i < DNSUtil.max_retry-1:
+                # UDP mode query, hedged between dnsservers
+                try:
+                    data = DNSUtil._udp_resolve(addrs, query, timeout)
+                    if data:
+                        return data
+                except OSError as e:
+                    logging.warning('DNSUtil._remote_resolve(dnsserver=%r, %r) udp failed: %s', dnsserver, qname, e)
+            else:
+                # TCP mode query
+                for addr in addrs:
+                    try:
+                        data = DNSUtil._tcp_resolve(addr, query, timeout)
+                        if data:
+                            return data
+                    except OSError as e:
+                        logging.warning('DNSUtil._remote_resolve(dnsserver=%r, %r) tcp failed: %s', addr, qname, e)
 
     @staticmethod
-    def remote_resolve(dnsserver, qname, timeout=None):
-        data = DNSUtil._remote_resolve(dnsserver, qname, timeout)
+    def remote_resolve(dnsserver, qname, timeout=None, qtype=TYPE_A):
+        data = DNSUtil._remote_resolve(dnsserver, qname, timeout, qtype)
         iplist = DNSUtil._reply_to_iplist(data or b'')
         return iplist
 
+    @staticmethod
+    def remote_resolve_with_ttl(dnsserver, qname, timeout=None, qtype=TYPE_A):
+        data = DNSUtil._remote_resolve(dnsserver, qname, timeout, qtype) or b''
+        return DNSUtil._reply_to_iplist(data), DNSUtil._reply_to_ttl(data)
+
+
+class DNSCache(object):
+    """DNS Cache with per-entry ttl, lru eviction, negative caching and stale-while-revalidate refresh
+
+    dns[host] = iplist pins a static entry which never expires nor evicts, dns.resolve(host, resolver)
+    looks up the others by resolver(host) -> (iplist, ttl), concurrent misses share one lookup.
+    DNSServer caches whole reply messages keyed by question in the same way.
+    """
+
+    max_size = 2048
+    negative_ttl = 30
+    max_stale = 600
+
+    def __init__(self, max_size=0, negative_ttl=0):
+        self.max_size = max_size or self.__class__.max_size
+        self.negative_ttl = negative_ttl or self.__class__.negative_ttl
+        # host -> [iplist, expire_time or None for static pins, lookup error]
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def __setitem__(self, host, iplist):
+        with self.lock:
+            self.entries.pop(host, None)
+            self.entries[host] = [iplist, None, None]
+
+    def __getitem__(self, host):
+        return self.entries[host][0]
+
+    def __delitem__(self, host):
+        with self.lock:
+            del self.entries[host]
+
+    def __contains__(self, host):
+        return host in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, host, default=None):
+        entry = self.entries.get(host)
+        return entry[0] if entry else default
+
+    def _store(self, host, entry):
+        with self.lock:
+            old_entry = self.entries.pop(host, None)
+            if old_entry and old_entry[1] is None:
+                # a static pin was set during lookup, keep it
+                entry = old_entry
+            self.entries[host] = entry
+            if len(self.entries) > self.max_size:
+                for key in [k for k, v in self.entries.items() if v[1] is not None][:len(self.entries)-self.max_size]:
+                    del self.entries[key]
+        return entry
+
+    def _lookup(self, host, resolver):
+        with self.lock:
+            event = self.inflight.get(host)
+            is_owner = event is None
+            if is_owner:
+                event = self.inflight[host] = threading.Event()
+        if not is_owner:
+            self.stats['coalesced'] += 1
+            event.wait()
+            return self.entries.get(host)
+        entry = None
+        try:
+            error = None
+            try:
+                iplist, ttl = resolver(host)
+            except OSError as e:
+                iplist, ttl, error = [], 0, e
+            if iplist:
+                entry = [iplist, time.time() + ttl, None]
+            else:
+                # an empty answer is as negative as a failure, likely a transient resolver error
+                entry = self.entries.get(host)
+                if not entry or not entry[0] or entry[1] is None or time.time() > entry[1] + self.max_stale:
+                    entry = [[], time.time() + self.negative_ttl, error]
+                # else a failed refresh keeps the good entry, serve it stale
+            entry = self._store(host, entry)
+        finally:
+            with self.lock:
+                del self.inflight[host]
+            event.set()
+        return entry
+
+    def _refresh(self, host, resolver):
+        try:
+            self._lookup(host, resolver)
+        except Exception as e:
+            logging.warning('DNSCache refresh host=%r failed: %r', host, e)
+
+    def resolve(self, host, resolver):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry:
+                self.entries.move_to_end(host)
+        if entry and (entry[1] is None or now < entry[1]):
+            self.stats['hit' if entry[0] else 'negative'] += 1
+        elif entry and now < entry[1] + self.max_stale and entry[0]:
+            # serve stale iplist, and revalidate it in background
+            self.stats['stale'] += 1
+            if host not in self.inflight:
+                threading._start_new_thread(self._refresh, (host, resolver))
+        else:
+            self.stats['miss'] += 1
+            entry = self._lookup(host, resolver) or [[], None, None]
+        if entry[2]:
+            raise entry[2]
+        return entry[0]
+
 
 def spawn_later(seconds, target, *args, **kwargs):
     def wrap(*args, **kwargs):
@@ -444,6 +1053,391 @@ def spawn_later(seconds, target, *args, **kwargs):
     return threading._start_new_thread(wrap, args, kwargs)
 
 
+class XORCodec(object):
+    """XOR Obfuscation Codec, a single byte key by a bytes.translate table, a longer key by wide integer xor"""
+
+    def __init__(self, key):
+        if isinstance(key, int):
+            key = bytes([key])
+        elif isinstance(key, str):
+            key = key.encode('latin-1')
+        if not key:
+            raise ValueError('XORCodec key must not be empty')
+        self.key = key
+        # stream position modulo len(key)
+        self.offset = 0
+        self.table = bytes(x ^ key[0] for x in range(256)) if len(key) == 1 else None
+
+    def transform(self, data):
+        if self.table:
+            return bytes(data).translate(self.table)
+        size = len(data)
+        if not size:
+            return b''
+        key = self.key[self.offset:] + self.key[:self.offset]
+        keystream = (key * (size // len(key) + 1))[:size]
+        self.offset = (self.offset + size) % len(self.key)
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(keystream, 'little')).to_bytes(size, 'little')
+
+    def transform_into(self, buffer, size):
+        """write the transform of the first size bytes of a writable buffer back over them, through one temporary copy"""
+        buffer[:size] = self.transform(buffer[:size])
+
+    def wrap(self, fileobj):
+        """decode everything read from fileobj, by read or by readinto a relay buffer"""
+        read = fileobj.read
+        readinto = getattr(fileobj, 'readinto', None)
+        fileobj.read = lambda amt=None: self.transform(read(amt))
+        if readinto:
+            def wrapped_readinto(buffer):
+                size = readinto(buffer)
+                if size:
+                    self.transform_into(buffer, size)
+                return size
+            fileobj.readinto = wrapped_readinto
+        return fileobj
+
+
+class BufferPool(object):
+    """Pool of Reusable bytearray Buffers for the body relay loops"""
+
+    bufsize = 64*1024
+    max_buffers = 64
+
+    def __init__(self, bufsize=0, max_buffers=0):
+        self.bufsize = bufsize or self.__class__.bufsize
+        self.max_buffers = max_buffers or self.__class__.max_buffers
+        self.buffers = []
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self):
+        with self.lock:
+            if self.buffers:
+                self.stats['reuse'] += 1
+                return self.buffers.pop()
+        self.stats['alloc'] += 1
+        return bytearray(self.bufsize)
+
+    def put(self, buffer):
+        with self.lock:
+            if len(self.buffers) < self.max_buffers and len(buffer) == self.bufsize:
+                self.buffers.append(buffer)
+
+
+class ForwardTunnel(object):
+    """Forwarded Socket Pair owned by a TunnelLoop"""
+
+    def __init__(self, local, remote, bufsize, timeout=60, maxping=None, maxpong=None, pongcallback=None, codecs=None):
+        self.local = local
+        self.remote = remote
+        self.bufsize = bufsize
+        # sock -> XORCodec applied to the bytes read from sock
+        self.codecs = codecs
+        self.peer = {local: remote, remote: local}
+        # sock -> bytes received from its peer and waiting to be sent to it
+        self.pending = {local: bytearray(), remote: bytearray()}
+        self.events = {local: 0, remote: 0}
+        # sockets read to the end
+        self.eof = set()
+        self.timeout = timeout
+        self.maxping = maxping
+        self.maxpong = maxpong
+        self.pongcallback = pongcallback
+        self.deadline = time.time() + timeout
+        # deadline of the live heap entry in TunnelLoop
+        self.scheduled = 0
+        self.closed = False
+
+    def touch(self, sock):
+        """data arrived on sock, move the idle deadline as forward_socket moves its timecount"""
+        if sock is self.remote:
+            self.deadline = time.time() + (self.maxpong or self.timeout)
+            if self.pongcallback:
+                try:
+                    self.pongcallback()
+                except Exception as e:
+                    logging.warning('remote=%s pongcallback=%s failed: %s', self.remote, self.pongcallback, e)
+                finally:
+                    self.pongcallback = None
+        else:
+            self.deadline = time.time() + (self.maxping or self.timeout)
+
+    def buffered(self, sock):
+        """number of bytes waiting to be sent to sock"""
+        return len(self.pending[sock])
+
+    def receive(self, sock):
+        """read from sock for its peer and send what the peer takes at once, return the number of bytes read"""
+        peer = self.peer[sock]
+        pending = self.pending[peer]
+        data = sock.recv(self.bufsize - len(pending))
+        size = len(data)
+        if data and self.codecs:
+            data = self.codecs[sock].transform(data)
+        if data and not pending:
+            try:
+                data = data[peer.send(data):]
+            except BlockingIOError:
+                pass
+        pending += data
+        return size
+
+    def flush(self, sock):
+        pending = self.pending[sock]
+        del pending[:sock.send(pending)]
+
+    def interest(self, sock):
+        events = 0
+        if sock not in self.eof and self.buffered(self.peer[sock]) < self.bufsize:
+            events |= selectors.EVENT_READ
+        if self.buffered(sock):
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def finished(self):
+        return len(self.eof) == 2 and not self.buffered(self.local) and not self.buffered(self.remote)
+
+    def close(self):
+        self.local.close()
+        self.remote.close()
+
+
+class SpliceTunnel(ForwardTunnel):
+    """Forwarded Socket Pair moved by os.splice through a pipe per direction, the payload never enters user space"""
+
+    def __init__(self, local, remote, bufsize, timeout=60, maxping=None, maxpong=None, pongcallback=None):
+        ForwardTunnel.__init__(self, local, remote, bufsize, timeout, maxping, maxpong, pongcallback)
+        # sock -> (read fd, write fd) of the pipe carrying bytes to sock
+        self.pipes = {}
+        try:
+            for sock in (local, remote):
+                self.pipes[sock] = rfd, wfd = os.pipe()
+                os.set_blocking(rfd, False)
+                os.set_blocking(wfd, False)
+                if hasattr(fcntl, 'F_SETPIPE_SZ'):
+                    # the pipe is the buffer of its direction
+                    self.bufsize = min(self.bufsize, fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, bufsize))
+                else:
+                    self.bufsize = min(self.bufsize, 65536)
+        except OSError:
+            self._close_pipes()
+            raise
+        self.pending = {local: 0, remote: 0}
+
+    def buffered(self, sock):
+        return self.pending[sock]
+
+    def receive(self, sock):
+        peer = self.peer[sock]
+        size = os.splice(sock.fileno(), self.pipes[peer][1], self.bufsize - self.pending[peer], flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.pending[peer] += size
+        if size:
+            try:
+                self.flush(peer)
+            except BlockingIOError:
+                pass
+        return size
+
+    def flush(self, sock):
+        self.pending[sock] -= os.splice(self.pipes[sock][0], sock.fileno(), self.pending[sock], flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+
+    def close(self):
+        ForwardTunnel.close(self)
+        self._close_pipes()
+
+    def _close_pipes(self):
+        for fds in self.pipes.values():
+            for fd in fds:
+                os.close(fd)
+        self.pipes = {}
+
+
+class TunnelLoop(object):
+    """Selector Event Loop Thread of TunnelMultiplexer, epoll on linux"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.incoming = collections.deque()
+        self.waker, self.wakeup_sock = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakeup_sock.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        # heap of (deadline, seq, tunnel), an entry is live only while deadline == tunnel.scheduled
+        self.deadlines = []
+        self.counter = itertools.count()
+        # live tunnels, counted up by the callers of add and down by the loop thread
+        self.tunnels = 0
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        threading._start_new_thread(self.run, ())
+
+    def add(self, tunnel):
+        with self.lock:
+            self.tunnels += 1
+        self.incoming.append(tunnel)
+        try:
+            self.wakeup_sock.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while 1:
+            timeout = max(0, self.deadlines[0][0] - time.time()) if self.deadlines else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._handle(key.data, key.fileobj, mask)
+            self._expire()
+
+    def _accept(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.incoming:
+            tunnel = self.incoming.popleft()
+            self.stats['tunnels'] += 1
+            try:
+                tunnel.local.setblocking(False)
+                tunnel.remote.setblocking(False)
+                self._schedule(tunnel)
+                self._update(tunnel)
+            except (OSError, ValueError) as e:
+                # closed by the caller meanwhile most likely
+                logging.warning('TunnelLoop add %s failed: %r', tunnel.local, e)
+                self._close(tunnel)
+
+    def _schedule(self, tunnel):
+        tunnel.scheduled = tunnel.deadline
+        heapq.heappush(self.deadlines, (tunnel.deadline, next(self.counter), tunnel))
+
+    def _expire(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, tunnel = heapq.heappop(self.deadlines)
+            if tunnel.closed or deadline != tunnel.scheduled:
+                continue
+            if tunnel.deadline > now:
+                # moved later by traffic, wake up again at the new deadline
+                self._schedule(tunnel)
+            else:
+                self.stats['timeout'] += 1
+                self._close(tunnel)
+
+    def _handle(self, tunnel, sock, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(tunnel, sock)
+            if mask & selectors.EVENT_READ:
+                self._receive(tunnel, sock)
+            if tunnel.finished():
+                self._close(tunnel)
+            else:
+                self._update(tunnel)
+        except OSError as e:
+            if e.args[0] not in (errno.ECONNABORTED, errno.ECONNRESET, errno.ENOTCONN, errno.EPIPE, errno.ETIMEDOUT):
+                logging.warning('TunnelLoop forward %s failed: %r', sock, e)
+            self._close(tunnel)
+        except Exception as e:
+            # one broken tunnel must not kill the thread and every other tunnel of it
+            logging.exception('TunnelLoop forward %s error: %r', sock, e)
+            self._close(tunnel)
+
+    def _receive(self, tunnel, sock):
+        peer = tunnel.peer[sock]
+        try:
+            size = tunnel.receive(sock)
+        except BlockingIOError:
+            return
+        if not size:
+            tunnel.eof.add(sock)
+            if not tunnel.buffered(peer):
+                self._shutdown(peer)
+            return
+        tunnel.touch(sock)
+        if tunnel.deadline < tunnel.scheduled:
+            # maxping or maxpong shorter than the scheduled timeout
+            self._schedule(tunnel)
+
+    def _flush(self, tunnel, sock):
+        try:
+            tunnel.flush(sock)
+        except BlockingIOError:
+            return
+        if not tunnel.buffered(sock) and tunnel.peer[sock] in tunnel.eof:
+            self._shutdown(sock)
+
+    def _shutdown(self, sock):
+        """half-close, the other direction goes on until its own eof"""
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def _update(self, tunnel):
+        for sock in (tunnel.local, tunnel.remote):
+            events = tunnel.interest(sock)
+            if events == tunnel.events[sock]:
+                continue
+            if not events:
+                self.selector.unregister(sock)
+            elif tunnel.events[sock]:
+                self.selector.modify(sock, events, tunnel)
+            else:
+                self.selector.register(sock, events, tunnel)
+            tunnel.events[sock] = events
+
+    def _close(self, tunnel):
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        with self.lock:
+            self.tunnels -= 1
+        for sock in (tunnel.local, tunnel.remote):
+            if tunnel.events[sock]:
+                try:
+                    self.selector.unregister(sock)
+                except (KeyError, ValueError):
+                    pass
+                tunnel.events[sock] = 0
+        tunnel.close()
+
+
+class TunnelMultiplexer(object):
+    """Multiplexer of CONNECT Tunnels on a few TunnelLoop threads, replaces a select loop thread per tunnel"""
+
+    threads = 2
+    bufsize = 64*1024
+
+    def __init__(self, threads=0, bufsize=0, splice=False):
+        self.threads = threads or self.__class__.threads
+        self.bufsize = bufsize or self.__class__.bufsize
+        self.splice = splice and hasattr(os, 'splice')
+        if splice and not self.splice:
+            logging.warning('os.splice is not available, [relay]splice falls back to copy')
+        self.loops = []
+        self.lock = threading.Lock()
+
+    def forward(self, local, remote, timeout=60, maxping=None, maxpong=None, pongcallback=None, bitmask=None):
+        """hand over a connected socket pair, the loop closes both when the tunnel is done or idle for timeout"""
+        with self.lock:
+            if len(self.loops) < self.threads:
+                self.loops.append(TunnelLoop())
+            loop = min(self.loops, key=lambda x: x.tunnels)
+        tunnel = None
+        codecs = {local: XORCodec(bitmask), remote: XORCodec(bitmask)} if bitmask else None
+        if self.splice and not codecs:
+            try:
+                tunnel = SpliceTunnel(local, remote, self.bufsize, timeout, maxping, maxpong, pongcallback)
+            except OSError as e:
+                # out of file descriptors for the pipes most likely
+                logging.warning('TunnelMultiplexer create SpliceTunnel failed: %r, fall back to copy', e)
+        loop.add(tunnel or ForwardTunnel(local, remote, self.bufsize, timeout, maxping, maxpong, pongcallback, codecs))
+
+
 class HTTPUtil(object):
     """HTTP Request Class"""
 
@@ -482,15 +1476,33 @@ class HTTPUtil(object):
                     'ECDH-RSA-DES-CBC3-SHA',
                     'ECDH-ECDSA-DES-CBC3-SHA',
                     'DES-CBC3-SHA']
-
-    def __init__(self, max_window=4, max_timeout=16, max_retry=4, proxy='', ssl_validate=False):
+    max_idle_connections = 8
+    max_idle_time = 60
+    max_ssl_sessions = 1024
+    max_ssl_session_time = 600
+    connect_stagger = 0.1
+    connection_score_file = 'proxy.scores'
+    dns_ttl = 300
+
+    def __init__(self, max_window=4, max_timeout=16, max_retry=4, proxy='', ssl_validate=False, relay_bufsize=0, tunnel_threads=0, relay_splice=False):
         self.max_window = max_window
         self.max_retry = max_retry
         self.max_timeout = max_timeout
-        self.tcp_connection_time = collections.defaultdict(float)
-        self.ssl_connection_time = collections.defaultdict(float)
+        self.tcp_connection_time = ConnectionScoreboard(failure_penalty=max_timeout)
+        self.ssl_connection_time = ConnectionScoreboard(failure_penalty=max_timeout)
         self.max_timeout = max_timeout
-        self.dns = {}
+        self.connection_pool = collections.defaultdict(collections.deque)
+        self.connection_pool_lock = threading.Lock()
+        self.connection_pool_stats = collections.Counter()
+        self.ssl_session_cache = collections.OrderedDict()
+        self.ssl_session_lock = threading.Lock()
+        self.ssl_session_stats = collections.Counter()
+        self.dns = DNSCache()
+        # per thread on_socket callback seeing every socket a request goes out on, RequestHedger cancels the loser through it
+        self.local = threading.local()
+        self.buffer_pool = BufferPool(relay_bufsize)
+        self.relay_stats = collections.Counter()
+        self.tunnel_multiplexer = TunnelMultiplexer(tunnel_threads, relay_bufsize, relay_splice) if tunnel_threads else None
         self.crlf = 0
         self.proxy = proxy
         self.ssl_validate = ssl_validate or self.ssl_validate
@@ -506,156 +1518,150 @@ class HTTPUtil(object):
             self.ssl_context.verify_mode = ssl.CERT_REQUIRED
             self.ssl_context.load_verify_locations('cacert.pem')
 
-    def dns_resolve(self, host, dnsserver='', ipv4_only=True):
-        iplist = self.dns.get(host)
-        if not iplist:
-            if not dnsserver:
-                iplist = list(set(socket.gethostbyname_ex(host)[-1]) - DNSUtil.blacklist)
-            else:
-                iplist = DNSUtil.remote_resolve(dnsserver, host, timeout=2)
+    def _dns_resolve(self, host, dnsserver='', ipv4_only=True):
+        ttl = None
+        if not dnsserver:
+            iplist = list(set(socket.gethostbyname_ex(host)[-1]) - DNSUtil.blacklist)
             if not iplist:
-                iplist = DNSUtil.remote_resolve('8.8.8.8', host, timeout=2)
-            if ipv4_only:
-                iplist = [ip for ip in iplist if re.match(r'\d+\.\d+\.\d+\.\d+', ip)]
-            self.dns[host] = iplist = list(set(iplist))
-        return iplist
+                iplist, ttl = DNSUtil.remote_resolve_with_ttl('8.8.8.8', host, timeout=2)
+        else:
+            iplist, ttl = DNSUtil.remote_resolve_with_ttl([dnsserver, '8.8.8.8'], host, timeout=2)
+        if ipv4_only:
+            iplist = [ip for ip in iplist if re.match(r'\d+\.\d+\.\d+\.\d+', ip)]
+        return list(set(iplist)), ttl if ttl is not None else self.dns_ttl
 
-    def create_connection(self, address, timeout=None, source_address=None):
-        def _create_connection(address, timeout, queobj):
-            sock = None
-            try:
-                # create a ipv4/ipv6 socket object
-                sock = socket.socket(socket.AF_INET if ':' not in address[0] else socket.AF_INET6)
-                # set reuseaddr option to avoid 10048 socket error
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                # resize socket recv buffer 8K->32K to improve browser releated application performance
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32*1024)
-                # disable negal algorithm to send http request quickly.
-                sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, True)
-                # set a short timeout to trigger timeout retry more quickly.
-                sock.settimeout(timeout or self.max_timeout)
-                # start connection time record
-                start_time = time.time()
-                # TCP connect
-                sock.connect(address)
-                # record TCP connection time
-                self.tcp_connection_time[address] = time.time() - start_time
-                # reset timeout default to avoid long http upload failure, but it will delay timeout retry :(
-                sock.settimeout(None)
-                # put ssl socket object to output queobj
-                queobj.put(sock)
-            except OSError as e:
-                # any socket.error, put Excpetions to output queobj.
-                queobj.put(e)
-                # reset a large and random timeout to the address
-                self.tcp_connection_time[address] = self.max_timeout+random.random()
-                # close tcp socket
-                if sock:
-                    sock.close()
+    def dns_resolve(self, host, dnsserver='', ipv4_only=True):
+        return self.dns.resolve(host, functools.partial(self._dns_resolve, dnsserver=dnsserver, ipv4_only=ipv4_only))
+
+    def _race_connection(self, addrs, timeout=None, server_hostname=None, ssl_wrap=False, ssl_validate=False):
+        """race connections to addrs with non-blocking sockets in current thread, return (first connected socket, first error)"""
+        timeout = timeout or self.max_timeout
+        connection_time = self.ssl_connection_time if ssl_wrap else self.tcp_connection_time
+        selector = selectors.DefaultSelector()
+        pending = collections.deque(addrs)
+        # attempts maps socket to (addr, start_time, connected, raw_sock)
+        attempts = {}
+        errors = []
+        next_start_time = 0
+        try:
+            while pending or attempts:
+                now = time.time()
+                if pending and (now >= next_start_time or not attempts):
+                    # start next connection attempt, staggered by connect_stagger
+                    addr = pending.popleft()
+                    sock = socket.socket(socket.AF_INET if ':' not in addr[0] else socket.AF_INET6)
+                    # set reuseaddr option to avoid 10048 socket error
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    # resize socket recv buffer 8K->32K to improve browser releated application performance
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32*1024)
+                    # disable negal algorithm to send http request quickly.
+                    sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, True)
+                    sock.setblocking(0)
+                    # 10035 is WSAEWOULDBLOCK
+                    err = sock.connect_ex(addr)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, 10035):
+                        errors.append(OSError(err, os.strerror(err)))
+                        connection_time.record_failure(addr)
+                        sock.close()
+                        continue
+                    attempts[sock] = (addr, now, False, sock)
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_start_time = now + self.connect_stagger
+                    continue
+                wakeup_time = min(start_time + timeout for _, start_time, _, _ in attempts.values())
+                if pending:
+                    wakeup_time = min(wakeup_time, next_start_time)
+                for key, _ in selector.select(max(wakeup_time - now, 0)):
+                    sock = key.fileobj
+                    addr, start_time, connected, raw_sock = attempts.pop(sock)
+                    selector.unregister(sock)
+                    try:
+                        if not connected:
+                            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                            if err:
+                                raise OSError(err, os.strerror(err))
+                            connected = True
+                            # record TCP connection time
+                            self.tcp_connection_time.record(addr, time.time() - start_time)
+                            if not ssl_wrap:
+                                # reset timeout default to avoid long http upload failure, but it will delay timeout retry :(
+                                sock.settimeout(None)
+                                return sock, None
+                            sock = self.ssl_context.wrap_socket(sock, do_handshake_on_connect=False, server_hostname=server_hostname, session=self.get_ssl_session(addr, server_hostname))
+                        # SSL handshake, it raises SSLWantReadError/SSLWantWriteError until finished
+                        sock.do_handshake()
+                        # record SSL connection time
+                        self.ssl_connection_time.record(addr, time.time() - start_time)
+                        # remember the session for next connection to the same ip and sni
+                        self.ssl_session_stats['resumed' if sock.session_reused else 'full'] += 1
+                        self.put_ssl_session(addr, server_hostname, sock.session)
+                        # verify SSL certificate.
+                        if ssl_validate:
+                            cert = sock.getpeercert()
+                            commonname = next((v for ((k, v),) in cert['subject'] if k == 'commonName'))
+                            if '.google' not in commonname and not commonname.endswith('.appspot.com'):
+                                raise ssl.SSLError("Host name '%s' doesn't match certificate host '%s'" % (server_hostname, commonname))
+                        # sometimes, we want to use raw tcp socket directly(select/epoll), so setattr it to ssl socket.
+                        sock.sock = raw_sock
+                        sock.settimeout(timeout)
+                        return sock, None
+                    except ssl.SSLWantReadError:
+                        attempts[sock] = (addr, start_time, connected, raw_sock)
+                        selector.register(sock, selectors.EVENT_READ)
+                    except ssl.SSLWantWriteError:
+                        attempts[sock] = (addr, start_time, connected, raw_sock)
+                        selector.register(sock, selectors.EVENT_WRITE)
+                    except OSError as e:
+                        errors.append(e)
+                        # count a failure penalty to the address
+                        connection_time.record_failure(addr)
+                        sock.close()
+                now = time.time()
+                for sock, (addr, start_time, _, _) in list(attempts.items()):
+                    if now - start_time >= timeout:
+                        del attempts[sock]
+                        selector.unregister(sock)
+                        sock.close()
+                        errors.append(socket.timeout('timed out'))
+                        connection_time.record_failure(addr)
+            return None, errors[0] if errors else None
+        finally:
+            for sock in attempts:
+                sock.close()
+            selector.close()
 
-        def _close_connection(count, queobj):
-            for i in range(count):
-                queobj.get()
+    def create_connection(self, address, timeout=None, source_address=None):
         host, port = address
-        result = None
         addresses = [(x, port) for x in self.dns_resolve(host)]
         if port == 443:
-            get_connection_time = lambda addr: self.ssl_connection_time.__getitem__(addr) or self.tcp_connection_time.__getitem__(addr)
+            get_connection_time = lambda addr: self.ssl_connection_time.get(addr) or self.tcp_connection_time[addr]
         else:
             get_connection_time = self.tcp_connection_time.__getitem__
         for i in range(self.max_retry):
             window = min((self.max_window+1)//2 + i, len(addresses))
             addresses.sort(key=get_connection_time)
             addrs = addresses[:window] + random.sample(addresses, window)
-            queobj = queue.Queue()
-            for addr in addrs:
-                threading._start_new_thread(_create_connection, (addr, timeout, queobj))
-            for i in range(len(addrs)):
-                result = queobj.get()
-                if not isinstance(result, OSError):
-                    threading._start_new_thread(_close_connection, (len(addrs)-i-1, queobj))
-                    return result
-                else:
-                    if i == 0:
-                        # only output first error
-                        logging.warning('create_connection to %s return %r, try again.', addrs, result)
+            sock, error = self._race_connection(addrs, timeout)
+            if sock:
+                return sock
+            logging.warning('create_connection to %s return %r, try again.', addrs, error)
 
     def create_ssl_connection(self, address, timeout=None, source_address=None):
-        def _create_ssl_connection(ipaddr, timeout, queobj):
-            sock = None
-            ssl_sock = None
-            try:
-                # create a ipv4/ipv6 socket object
-                sock = socket.socket(socket.AF_INET if ':' not in ipaddr[0] else socket.AF_INET6)
-                # set reuseaddr option to avoid 10048 socket error
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                # resize socket recv buffer 8K->32K to improve browser releated application performance
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32*1024)
-                # disable negal algorithm to send http request quickly.
-                sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, True)
-                # set a short timeout to trigger timeout retry more quickly.
-                sock.settimeout(timeout or self.max_timeout)
-                # pick up the certificate
-                server_hostname = None
-                if ssl.HAS_SNI and address[0].endswith('.appspot.com'):
-                    server_hostname = 'www.google.com'
-                ssl_sock = self.ssl_context.wrap_socket(sock, do_handshake_on_connect=False, server_hostname=server_hostname)
-                # start connection time record
-                start_time = time.time()
-                # TCP connect
-                ssl_sock.connect(ipaddr)
-                connected_time = time.time()
-                # SSL handshake
-                ssl_sock.do_handshake()
-                handshaked_time = time.time()
-                # record TCP connection time
-                self.tcp_connection_time[ipaddr] = connected_time - start_time
-                # record SSL connection time
-                self.ssl_connection_time[ipaddr] = handshaked_time - start_time
-                # sometimes, we want to use raw tcp socket directly(select/epoll), so setattr it to ssl socket.
-                ssl_sock.sock = sock
-                # verify SSL certificate.
-                if self.ssl_validate and address[0].endswith('.appspot.com'):
-                    cert = ssl_sock.getpeercert()
-                    commonname = next((v for ((k, v),) in cert['subject'] if k == 'commonName'))
-                    if '.google' not in commonname and not commonname.endswith('.appspot.com'):
-                        raise ssl.SSLError("Host name '%s' doesn't match certificate host '%s'" % (address[0], commonname))
-                # put ssl socket object to output queobj
-                queobj.put(ssl_sock)
-            except OSError as e:
-                # any socket.error, put Excpetions to output queobj.
-                queobj.put(e)
-                # reset a large and random timeout to the ipaddr
-                self.ssl_connection_time[ipaddr] = self.max_timeout + random.random()
-                # close ssl socket
-                if ssl_sock:
-                    ssl_sock.close()
-                # close tcp socket
-                if sock:
-                    sock.close()
-
-        def _close_ssl_connection(count, queobj):
-            for i in range(count):
-                queobj.get()
         host, port = address
-        result = None
+        # pick up the certificate
+        server_hostname = None
+        if ssl.HAS_SNI and host.endswith('.appspot.com'):
+            server_hostname = 'www.google.com'
+        ssl_validate = self.ssl_validate and host.endswith('.appspot.com')
         addresses = [(x, port) for x in self.dns_resolve(host)]
         for i in range(self.max_retry):
             window = min((self.max_window+1)//2 + i, len(addresses))
             addresses.sort(key=self.ssl_connection_time.__getitem__)
             addrs = addresses[:window] + random.sample(addresses, window)
-            queobj = queue.Queue()
-            for addr in addrs:
-                threading._start_new_thread(_create_ssl_connection, (addr, timeout, queobj))
-            for i in range(len(addrs)):
-                result = queobj.get()
-                if not isinstance(result, OSError):
-                    threading._start_new_thread(_close_ssl_connection, (len(addrs)-i-1, queobj))
-                    return result
-                else:
-                    if i == 0:
-                        # only output first error
-                        logging.warning('create_ssl_connection to %s return %r, try again.', addrs, result)
+            ssl_sock, error = self._race_connection(addrs, timeout, server_hostname=server_hostname, ssl_wrap=True, ssl_validate=ssl_validate)
+            if ssl_sock:
+                return ssl_sock
+            logging.warning('create_ssl_connection to %s return %r, try again.', addrs, error)
 
     def create_connection_withdata(self, address, timeout=None, source_address=None, data=None):
         assert isinstance(data, str) and data
@@ -663,9 +1669,9 @@ class HTTPUtil(object):
         # result = None
         addresses = [(x, port) for x in self.dns_resolve(host)]
         if port == 443:
-            get_connection_time = lambda addr: self.ssl_connection_time.get(addr) or self.tcp_connection_time.get(addr)
+            get_connection_time = lambda addr: self.ssl_connection_time.get(addr) or self.tcp_connection_time[addr]
         else:
-            get_connection_time = self.tcp_connection_time.get
+            get_connection_time = self.tcp_connection_time.__getitem__
         for i in range(self.max_retry):
             window = min((self.max_window+1)//2 + i, len(addresses))
             addresses.sort(key=get_connection_time)
@@ -716,7 +1722,103 @@ class HTTPUtil(object):
             logging.error('create_connection_withproxy error %s', e)
             raise
 
+    def relay(self, source, dest, callback=None):
+        """copy the body of source to socket dest until eof, return the number of bytes copied
+
+        without a callback and with a plain socket dest, a regular file goes by os.sendfile and a http.client.HTTPResponse
+        of known length over a plain socket by os.splice, everything else is copied by readinto a pooled buffer and one
+        write per filled buffer. callback(view) sees every chunk before it is written.
+        """
+        zerocopy = not callback and not isinstance(dest, ssl.SSLSocket)
+        if zerocopy and isinstance(getattr(source, 'raw', source), io.FileIO):
+            self.relay_stats['sendfile'] += 1
+            return dest.sendfile(source)
+        if zerocopy and hasattr(os, 'splice') and isinstance(source, http.client.HTTPResponse):
+            sock = getattr(getattr(source.fp, 'raw', None), '_sock', None)
+            if isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket) and not source.chunked and source.length and 'read' not in vars(source):
+                self.relay_stats['splice'] += 1
+                return self._relay_splice(source, sock, dest)
+        self.relay_stats['copy'] += 1
+        # a wrapped read decodes the body, readinto would bypass it unless it is wrapped too
+        if isinstance(source, socket.socket):
+            readinto = source.recv_into
+        elif 'read' in vars(source) and 'readinto' not in vars(source):
+            readinto = None
+        else:
+            readinto = getattr(source, 'readinto', None)
+        buffer = self.buffer_pool.get()
+        view = memoryview(buffer)
+        copied = 0
+        try:
+            while 1:
+                if readinto:
+                    size = readinto(view)
+                    data = view[:size]
+                else:
+                    data = source.read(len(buffer))
+                    size = len(data)
+                if not size:
+                    break
+                if callback:
+                    callback(data)
+                dest.sendall(data)
+                copied += size
+        finally:
+            view.release()
+            self.buffer_pool.put(buffer)
+        return copied
+
+    def _relay_splice(self, response, sock, dest):
+        """relay the body of response by os.splice from its socket, the bytes already buffered by response.fp go first"""
+        buffered = response.fp.peek(1)[:response.length]
+        if buffered:
+            dest.sendall(response.fp.read(len(buffered)))
+            response.length -= len(buffered)
+        copied = len(buffered)
+        if response.length:
+            moved = self.splice(sock, dest, response.length)
+            response.length -= moved
+            copied += moved
+        if not response.length:
+            # same as http.client.HTTPResponse.read at the end of body, so the connection goes back to pool
+            response._close_conn()
+        return copied
+
+    def splice(self, source, dest, count=None, pipe=None):
+        """move count bytes, or until eof, from socket source to socket dest through a pipe in kernel, return bytes moved"""
+        rfd, wfd = pipe or os.pipe()
+        moved = 0
+        try:
+            while count is None or moved < count:
+                size = self.buffer_pool.bufsize if count is None else min(self.buffer_pool.bufsize, count - moved)
+                try:
+                    n = os.splice(source.fileno(), wfd, size, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    if not select.select([source], [], [], source.gettimeout())[0]:
+                        raise socket.timeout('splice recv timed out')
+                    continue
+                if not n:
+                    break
+                moved += n
+                while n:
+                    try:
+                        n -= os.splice(rfd, dest.fileno(), n, flags=os.SPLICE_F_MOVE)
+                    except BlockingIOError:
+                        if not select.select([], [dest], [], dest.gettimeout())[1]:
+                            raise socket.timeout('splice send timed out')
+        finally:
+            if not pipe:
+                os.close(rfd)
+                os.close(wfd)
+        return moved
+
     def forward_socket(self, local, remote, timeout=60, tick=2, bufsize=8192, maxping=None, maxpong=None, pongcallback=None, bitmask=None):
+        if self.tunnel_multiplexer:
+            # the multiplexer owns the file descriptors from now on, local and remote are left closed for the caller
+            self.tunnel_multiplexer.forward(socket.socket(fileno=local.detach()), socket.socket(fileno=remote.detach()), timeout=timeout, maxping=maxping, maxpong=maxpong, pongcallback=pongcallback, bitmask=bitmask)
+            return
+        # one codec per direction, as a stream codec may keep state of its stream
+        codecs = {local: XORCodec(bitmask), remote: XORCodec(bitmask)} if bitmask else None
         try:
             timecount = timeout
             while 1:
@@ -729,8 +1831,8 @@ class HTTPUtil(object):
                 if ins:
                     for sock in ins:
                         data = sock.recv(bufsize)
-                        if bitmask:
-                            data = ''.join(chr(ord(x) ^ bitmask) for x in data)
+                        if codecs:
+                            data = codecs[sock].transform(data)
                         if data:
                             if sock is remote:
                                 local.sendall(data)
@@ -760,6 +1862,7 @@ class HTTPUtil(object):
 
     def green_forward_socket(self, local, remote, timeout=60, tick=2, bufsize=8192, maxping=None, maxpong=None, pongcallback=None, bitmask=None):
         def io_copy(dest, source):
+            codec = XORCodec(bitmask) if bitmask else None
             try:
                 dest.settimeout(timeout)
                 source.settimeout(timeout)
@@ -767,8 +1870,8 @@ class HTTPUtil(object):
                     data = source.recv(bufsize)
                     if not data:
                         break
-                    if bitmask:
-                        data = ''.join(chr(ord(x) ^ bitmask) for x in data)
+                    if codec:
+                        data = codec.transform(data)
                     dest.sendall(data)
             except OSError as e:
                 if e.args[0] not in ('timed out', errno.ECONNABORTED, errno.ECONNRESET, errno.EBADF, errno.EPIPE, errno.ENOTCONN, errno.ETIMEDOUT):
@@ -781,6 +1884,114 @@ class HTTPUtil(object):
         threading._start_new_thread(io_copy, (remote.dup(), local.dup()))
         io_copy(local, remote)
 
+    def load_connection_scores(self, filename):
+        """load connection scoreboard snapshot, so that known-good ips are picked from the first request"""
+        if not os.path.isfile(filename):
+            return
+        try:
+            with open(filename, 'rb') as fp:
+                scores = json.loads(fp.read().decode('utf-8'))
+            self.tcp_connection_time.load(scores.get('tcp', []))
+            self.ssl_connection_time.load(scores.get('ssl', []))
+            logging.info('load connection scores of %d addresses from %r', len(self.ssl_connection_time) + len(self.tcp_connection_time), filename)
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning('load_connection_scores(filename=%r) failed: %s', filename, e)
+
+    def save_connection_scores(self, filename, interval=0):
+        """snapshot connection scoreboard to disk, repeat it every interval seconds if interval is given"""
+        while 1:
+            if interval:
+                time.sleep(interval)
+            try:
+                content = json.dumps({'tcp': self.tcp_connection_time.dump(), 'ssl': self.ssl_connection_time.dump()})
+                with open(filename + '.tmp', 'wb') as fp:
+                    fp.write(content.encode('utf-8'))
+                os.replace(filename + '.tmp', filename)
+            except OSError as e:
+                logging.warning('save_connection_scores(filename=%r) failed: %s', filename, e)
+            if not interval:
+                break
+
+    def get_ssl_session(self, ipaddr, server_hostname):
+        """get a cached and unexpired ssl session of (ipaddr, server_hostname)"""
+        key = (ipaddr, server_hostname)
+        with self.ssl_session_lock:
+            session = self.ssl_session_cache.get(key)
+            if session:
+                if time.time() - session.time < min(session.timeout, self.max_ssl_session_time):
+                    return session
+                del self.ssl_session_cache[key]
+
+    def put_ssl_session(self, ipaddr, server_hostname, session):
+        """cache ssl session of (ipaddr, server_hostname), a newer session ticket replaces the old one"""
+        if session is None:
+            return
+        key = (ipaddr, server_hostname)
+        with self.ssl_session_lock:
+            self.ssl_session_cache.pop(key, None)
+            self.ssl_session_cache[key] = session
+            while len(self.ssl_session_cache) > self.max_ssl_sessions:
+                self.ssl_session_cache.popitem(last=False)
+
+    @staticmethod
+    def _is_idle_connection_alive(sock):
+        try:
+            if hasattr(sock, 'pending') and sock.pending():
+                return False
+            # an idle keep-alive connection must not be readable, otherwise it is EOF or garbage
+            (ins, _, errors) = select.select([sock], [], [sock], 0)
+            return not ins and not errors
+        except (OSError, ValueError):
+            return False
+
+    def get_idle_connection(self, key):
+        """pop a healthy idle connection of (scheme, host, port) from connection pool"""
+        now = time.time()
+        with self.connection_pool_lock:
+            pool = self.connection_pool.get(key)
+            while pool:
+                idle_since, sock = pool.pop()
+                if now - idle_since < self.max_idle_time and self._is_idle_connection_alive(sock):
+                    self.connection_pool_stats['hit'] += 1
+                    return sock
+                self.connection_pool_stats['expire'] += 1
+                sock.close()
+            self.connection_pool_stats['miss'] += 1
+
+    def put_idle_connection(self, key, sock):
+        """push a connection whose response was fully read back to connection pool"""
+        now = time.time()
+        if isinstance(sock, ssl.SSLSocket):
+            # session tickets may arrive after the handshake, refresh them here
+            try:
+                self.put_ssl_session(sock.getpeername()[:2], sock.server_hostname, sock.session)
+            except OSError:
+                pass
+        with self.connection_pool_lock:
+            pool = self.connection_pool[key]
+            while pool and (len(pool) >= self.max_idle_connections or now - pool[0][0] >= self.max_idle_time):
+                self.connection_pool_stats['expire'] += 1
+                pool.popleft()[1].close()
+            pool.append((now, sock))
+
+    def _release_on_complete(self, key, response, sock):
+        """hook response, so its connection goes back to pool when body is read to the end"""
+        if response.will_close:
+            return response
+        fp = response.fp
+        close_conn = response._close_conn
+
+        def _close_conn():
+            # response.close() before the end or a replaced fp means the connection is out of sync
+            reusable = response.fp is fp and not response.closed and (response.chunked or not response.length)
+            close_conn()
+            if reusable:
+                self.put_idle_connection(key, sock)
+            else:
+                sock.close()
+        response._close_conn = _close_conn
+        return response
+
     def _request(self, sock, method, path, protocol_version, headers, payload, bufsize=8192, crlf=None, return_sock=None):
         skip_headers = self.skip_headers
         need_crlf = http_util.crlf
@@ -829,6 +2040,11 @@ class HTTPUtil(object):
             response = None
         return response
 
+    def _track(self, sock):
+        on_socket = getattr(self.local, 'on_socket', None)
+        if on_socket:
+            on_socket(sock)
+
     def request(self, method, url, payload=None, headers={}, realhost='', fullurl=False, bufsize=8192, crlf=None, return_sock=None):
         scheme, netloc, path, params, query, fragment = urllib.parse.urlparse(url)
         if netloc.rfind(':') <= netloc.rfind(']'):
@@ -843,10 +2059,23 @@ class HTTPUtil(object):
         if 'Host' not in headers:
             headers['Host'] = host
 
+        connection_key = (scheme, realhost or host, port)
         for i in range(self.max_retry):
             sock = None
             ssl_sock = None
             try:
+                if not self.proxy and not return_sock and not hasattr(payload, 'read'):
+                    # a streamed payload cannot be replayed if the idle connection turns out dead
+                    idle_sock = self.get_idle_connection(connection_key)
+                    if idle_sock:
+                        try:
+                            self._track(idle_sock)
+                            response = self._request(idle_sock, method, path, self.protocol_version, headers, payload, bufsize=bufsize, crlf=0)
+                            if response:
+                                return self._release_on_complete(connection_key, response, idle_sock)
+                        except (OSError, http.client.HTTPException) as e:
+                            logging.debug('request "%s %s" over idle connection failed:%s', method, url, e)
+                        idle_sock.close()
                 if not self.proxy:
                     if scheme == 'https':
                         ssl_sock = self.create_ssl_connection((realhost or host, port), self.max_timeout)
@@ -866,19 +2095,454 @@ class HTTPUtil(object):
                 if sock:
                     if scheme == 'https':
                         crlf = 0
-                    return self._request(ssl_sock or sock, method, path, self.protocol_version, headers, payload, bufsize=bufsize, crlf=crlf, return_sock=return_sock)
+                    self._track(ssl_sock or sock)
+                    response = self._request(ssl_sock or sock, method, path, self.protocol_version, headers, payload, bufsize=bufsize, crlf=crlf, return_sock=return_sock)
+                    if response and not self.proxy and not return_sock:
+                        response = self._release_on_complete(connection_key, response, ssl_sock or sock)
+                    return response
             except Exception as e:
                 logging.debug('request "%s %s" failed:%s', method, url, e)
                 if ssl_sock:
                     ssl_sock.close()
                 if sock:
                     sock.close()
-                if i == self.max_retry - 1:
+                if i == self.max_retry - 1 or getattr(payload, 'consumed', 0):
                     raise
                 else:
                     continue
 
 
+class GoogleIPScanner(object):
+    """Google Front-End IP Scanner, probes candidate ips with bounded concurrency and keeps a ranked live ip pool"""
+
+    port = 443
+    server_hostname = 'www.google.com'
+    cert_names = ('.google', '.appspot.com')
+    min_publish_size = 4
+
+    def __init__(self, ranges=(), seeds=(), threads=4, rate=2, max_pool_size=32, timeout=4, scoreboard=None, ssl_context=None, callback=None):
+        self.networks = [ipaddress.ip_network(x.strip(), strict=False) for x in ranges if x.strip()]
+        self.seeds = [x for x in seeds if re.match(r'\d+\.\d+\.\d+\.\d+$', x)]
+        self.threads = threads
+        self.rate = rate
+        self.max_pool_size = max_pool_size
+        self.timeout = timeout
+        self.scoreboard = scoreboard or ConnectionScoreboard(failure_penalty=timeout)
+        self.ssl_context = ssl_context or self._create_ssl_context()
+        self.callback = callback
+        self.pool = set()
+        self.candidates = collections.deque()
+        self.lock = threading.Lock()
+        self.next_probe_time = 0
+        self.last_iplist = []
+        self.stats = collections.Counter()
+        self._stopped = None
+
+    @staticmethod
+    def _create_ssl_context():
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_REQUIRED
+        ssl_context.load_verify_locations('cacert.pem')
+        return ssl_context
+
+    def _next_candidate(self):
+        with self.lock:
+            if not self.candidates:
+                # re-probe live ips and seeds each round, then fill the round with random ips of ranges
+                self.candidates.extend(sorted(self.pool))
+                self.candidates.extend(x for x in self.seeds if x not in self.pool)
+                for network in random.sample(self.networks, len(self.networks)):
+                    if network.num_addresses > 2:
+                        self.candidates.append(str(network[random.randint(1, network.num_addresses-2)]))
+            return self.candidates.popleft() if self.candidates else None
+
+    def _wait_rate(self):
+        if self.rate <= 0:
+            # no rate limit, threads bounds the probes
+            return
+        with self.lock:
+            now = time.time()
+            wait = max(self.next_probe_time - now, 0)
+            self.next_probe_time = max(self.next_probe_time, now) + 1.0 / self.rate
+        if wait:
+            time.sleep(wait)
+
+    def probe(self, ip):
+        """TCP+TLS connect to ip, return handshake time, or None if ip is unreachable or certificate names mismatch"""
+        addr = (ip, self.port)
+        sock = None
+        start_time = time.time()
+        try:
+            sock = socket.create_connection(addr, timeout=self.timeout)
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.server_hostname)
+            elapsed = time.time() - start_time
+            cert = sock.getpeercert() or {}
+            names = [v for ((k, v),) in cert.get('subject', ()) if k == 'commonName'] + [v for k, v in cert.get('subjectAltName', ()) if k == 'DNS']
+            if not any(x in name for name in names for x in self.cert_names):
+                raise ssl.SSLError('certificate names %r of %r mismatch %r' % (names, ip, self.cert_names))
+            self.scoreboard.record(addr, elapsed)
+            self.stats['live'] += 1
+            return elapsed
+        except (OSError, ValueError) as e:
+            self.stats['dead'] += 1
+            # only known ips are recorded, random ips of ranges would flood the scoreboard
+            if ip in self.pool or addr in self.scoreboard:
+                self.scoreboard.record_failure(addr)
+            logging.debug('GoogleIPScanner.probe(%r) failed: %r', ip, e)
+        finally:
+            if sock:
+                sock.close()
+
+    def iplist(self):
+        """return live ips ranked by scoreboard, ips went bad are left out, seeds make up a small pool"""
+        with self.lock:
+            pool = list(self.pool)
+        is_good = lambda x: self.scoreboard[(x, self.port)] < self.timeout
+        iplist = sorted(filter(is_good, pool), key=lambda x: self.scoreboard[(x, self.port)])
+        if len(iplist) < self.min_publish_size:
+            iplist += [x for x in self.seeds if x not in iplist and is_good(x)]
+        return iplist
+
+    def _update_pool(self, ip, elapsed):
+        with self.lock:
+            if elapsed is None:
+                self.pool.discard(ip)
+            else:
+                self.pool.add(ip)
+                if len(self.pool) > self.max_pool_size:
+                    self.pool.remove(max(self.pool, key=lambda x: self.scoreboard[(x, self.port)]))
+        iplist = self.iplist()
+        if iplist and iplist != self.last_iplist:
+            self.last_iplist = iplist
+            if self.callback:
+                self.callback(iplist)
+
+    def _scan(self):
+        while not self._stopped:
+            self._wait_rate()
+            ip = self._next_candidate()
+            if not ip:
+                time.sleep(1)
+                continue
+            self._update_pool(ip, self.probe(ip))
+
+    def start(self):
+        for i in range(self.threads):
+            threading._start_new_thread(self._scan, ())
+
+    def stop(self):
+        self._stopped = True
+
+
+class AppidScheduler(object):
+    """Quota Aware GAE Appid Scheduler, shared by do_METHOD_GAE and RangeFetch"""
+
+    daily_bytes = 1024*1024*1024
+    quota_utc_offset = -8*3600
+    default_latency = 1.0
+    max_errors = 2
+    error_window = 60
+    retry_delay = 30
+    # requests wait out shorter cooldowns of all appids, and fail fast on longer ones like an exhausted quota
+    max_wait = 5
+
+    def __init__(self, appids, daily_bytes=0):
+        self.appids = list(appids)
+        self.daily_bytes = daily_bytes or self.__class__.daily_bytes
+        self.states = dict((appid, self._new_state()) for appid in self.appids)
+        self.lock = threading.Lock()
+
+    def _new_state(self):
+        return {'day': self._quota_day(), 'bytes': 0, 'requests': 0, 'inflight': 0, 'latency': 0, 'errors': collections.deque(), 'cooldown_until': 0}
+
+    def _quota_day(self, now=None):
+        # gae quota resets at midnight pacific time, it comes an hour earlier in summer so cooldowns end late rather than early
+        return int(((now or time.time()) + self.quota_utc_offset) // 86400)
+
+    def _quota_reset_time(self, now=None):
+        return (self._quota_day(now) + 1) * 86400 - self.quota_utc_offset
+
+    def _state(self, appid, now):
+        state = self.states.get(appid)
+        if state is None or state['day'] != self._quota_day(now):
+            inflight = state['inflight'] if state else 0
+            state = self.states[appid] = self._new_state()
+            state['inflight'] = inflight
+        while state['errors'] and state['errors'][0] < now - self.error_window:
+            state['errors'].popleft()
+        return state
+
+    def _score(self, state, now):
+        if state['cooldown_until'] > now:
+            return (1, state['cooldown_until'], 0)
+        spare = max(0.05, 1 - float(state['bytes']) / self.daily_bytes)
+        return (0, 0, (state['latency'] or self.default_latency) * (1 + state['inflight']) * (1 + len(state['errors'])) / spare)
+
+    def choose(self, appids=None):
+        """return the healthiest appid with spare quota and count it in flight, the one back from cooldown first when all are cooling down"""
+        now = time.time()
+        with self.lock:
+            appid = min(appids or self.appids, key=lambda x: self._score(self._state(x, now), now))
+            state = self._state(appid, now)
+            state['inflight'] += 1
+            state['requests'] += 1
+        return appid
+
+    def cooldown(self, appids=None):
+        """return seconds until the first of appids is back from cooldown, 0 when one is usable now"""
+        now = time.time()
+        with self.lock:
+            return max(0, min(self._state(x, now)['cooldown_until'] for x in appids or self.appids) - now)
+
+    def record(self, appid, app_status, latency=None):
+        """record the response status and latency of a request got by choose, app_status 0 means it failed"""
+        now = time.time()
+        with self.lock:
+            state = self._state(appid, now)
+            state['inflight'] = max(0, state['inflight'] - 1)
+            if app_status == 200:
+                if latency is not None:
+                    state['latency'] = latency if not state['latency'] else state['latency'] * 0.7 + latency * 0.3
+            elif app_status == 503:
+                # a single 503 may be a busy instance, repeated ones mean the daily quota is gone
+                state['errors'].append(now)
+                if len(state['errors']) >= self.max_errors:
+                    state['cooldown_until'] = self._quota_reset_time(now)
+                    logging.warning('AppidScheduler appid=%r over quota, cooldown until %s', appid, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['cooldown_until'])))
+                else:
+                    state['cooldown_until'] = max(state['cooldown_until'], now + self.retry_delay)
+            elif app_status == 0:
+                state['errors'].append(now)
+
+    def account(self, appid, size):
+        with self.lock:
+            self._state(appid, time.time())['bytes'] += size
+
+    def dump(self):
+        now = time.time()
+        with self.lock:
+            return dict((appid, dict(self._state(appid, now), errors=len(self._state(appid, now)['errors']))) for appid in self.appids)
+
+
+class RequestHedger(object):
+    """Hedge Idempotent Requests after the p95 of recent time to first byte, the extra requests capped by a per-route budget"""
+
+    min_samples = 20
+    max_samples = 128
+    default_delay = 2.0
+    min_delay = 0.2
+    budget_ratio = 0.1
+    max_budget = 3.0
+    max_routes = 1024
+
+    def __init__(self, budget_ratio=0, http_util=None):
+        self.budget_ratio = budget_ratio or self.__class__.budget_ratio
+        # the sockets its requests go out on are tracked to cancel the loser
+        self.http_util = http_util
+        self.samples = collections.deque(maxlen=self.max_samples)
+        # route -> hedge tokens, every request earns budget_ratio token, every hedge spends one
+        self.budgets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def delay(self):
+        if len(self.samples) < self.min_samples:
+            return self.default_delay
+        samples = sorted(self.samples)
+        return max(samples[int(len(samples) * 0.95)], self.min_delay)
+
+    def _earn(self, route):
+        with self.lock:
+            tokens = self.budgets.pop(route, self.max_budget)
+            self.budgets[route] = min(tokens + self.budget_ratio, self.max_budget)
+            if len(self.budgets) > self.max_routes:
+                self.budgets.popitem(last=False)
+
+    def _spend(self, route):
+        with self.lock:
+            if self.budgets.get(route, 0) < 1:
+                return False
+            self.budgets[route] -= 1
+            return True
+
+    def fetch(self, route, primary, secondary):
+        """call primary(), and secondary() too when primary is slower than delay(), return the result of the first responding one
+
+        both return a (response, key) tuple, the connections of the loser are shut down as soon as the winner responds.
+        """
+        self._earn(route)
+        results = queue.Queue()
+        # name -> sockets of the requests still running
+        state = {'done': False, 'running': {}}
+
+        def cancel(sock):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        def run(fetch, name):
+            sockets = state['running'][name] = []
+
+            def on_socket(sock):
+                with self.lock:
+                    sockets.append(sock)
+                    done = state['done']
+                if done:
+                    # lost already, a retried connection fails at once too
+                    cancel(sock)
+            if self.http_util:
+                self.http_util.local.on_socket = on_socket
+            start_time = time.time()
+            try:
+                result, error = fetch(), None
+            except Exception as e:
+                result, error = (None, None), e
+            finally:
+                if self.http_util:
+                    self.http_util.local.on_socket = None
+            losers = []
+            with self.lock:
+                del state['running'][name]
+                if result[0] is not None:
+                    self.samples.append(time.time() - start_time)
+                won = result[0] is not None and not state['done']
+                if won:
+                    state['done'] = True
+                    losers = list(state['running'].values())
+            for loser in losers:
+                self.stats['cancelled'] += 1
+                for sock in loser:
+                    cancel(sock)
+            if result[0] is not None and not won:
+                result[0].close()
+            results.put((name, result if won else None, error))
+
+        threading._start_new_thread(run, (primary, 'primary'))
+        pending = 1
+        try:
+            name, result, error = results.get(timeout=self.delay())
+            pending -= 1
+        except queue.Empty:
+            name, result, error = None, None, None
+            if self._spend(route):
+                self.stats['hedged'] += 1
+                threading._start_new_thread(run, (secondary, 'secondary'))
+                pending += 1
+        while result is None and pending:
+            name, result, error = results.get()
+            pending -= 1
+        if result is None:
+            if error:
+                raise error
+            return None, None
+        self.stats[name] += 1
+        return result
+
+
+class URLFetchFlight(object):
+    """In-Flight GAE Response shared by identical concurrent requests"""
+
+    def __init__(self, key, request_headers):
+        self.key = key
+        self.request_headers = request_headers
+        self.condition = threading.Condition()
+        self.status = None
+        self.headers = None
+        self.vary = ()
+        self.chunks = []
+        self.done = False
+        self.complete = False
+
+    def start(self, status, headers):
+        """publish the response head, headers is a list of (name, value)"""
+        vary = tuple(x.strip().title() for k, v in headers if k.title() == 'Vary' for x in v.split(',') if x.strip())
+        with self.condition:
+            self.status, self.headers, self.vary = status, headers, vary
+            self.condition.notify_all()
+
+    def write(self, data):
+        with self.condition:
+            self.chunks.append(data)
+            self.condition.notify_all()
+
+    def close(self, complete=False):
+        with self.condition:
+            if not self.done:
+                self.done = True
+                self.complete = complete and self.headers is not None
+                self.condition.notify_all()
+
+    def matches(self, request_headers):
+        """whether the response may be shared with request_headers, by the vary headers of the response"""
+        return '*' not in self.vary and all(request_headers.get(x, '') == self.request_headers.get(x, '') for x in self.vary)
+
+    def wait_response(self, timeout):
+        """return (status, headers) of the response, or None when the leader gives up sharing it"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.headers is not None or self.done, timeout)
+            if self.headers is None:
+                return None
+            return self.status, self.headers
+
+    def iter_body(self, timeout):
+        index = 0
+        while 1:
+            with self.condition:
+                if not self.condition.wait_for(lambda: index < len(self.chunks) or self.done, timeout):
+                    raise socket.timeout('shared urlfetch timed out')
+                chunks = self.chunks[index:]
+                done = self.done and index + len(chunks) == len(self.chunks)
+            index += len(chunks)
+            for data in chunks:
+                yield data
+            if done:
+                if not self.complete:
+                    raise OSError(errno.ECONNRESET, 'shared urlfetch aborted')
+                return
+
+
+class URLFetchFlights(object):
+    """Single-Flight Coalescing of Identical Concurrent GAE Requests"""
+
+    max_size = 4*1024*1024
+    timeout = 60
+    # never share a response between different credentials, whatever the response varies on
+    key_headers = ('Cookie', 'Authorization')
+
+    def __init__(self, max_size=0, timeout=0):
+        self.max_size = max_size or self.__class__.max_size
+        self.timeout = timeout or self.__class__.timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def join(self, method, url, headers):
+        """return (flight, leader), the leader must fetch, publish the response to flight and close it"""
+        key = (method, url) + tuple(headers.get(x, '') for x in self.key_headers)
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight:
+                self.stats['coalesced'] += 1
+                return flight, False
+            flight = self.flights[key] = URLFetchFlight(key, dict((k.title(), v) for k, v in headers.items()))
+            self.stats['leader'] += 1
+            return flight, True
+
+    def shareable(self, response):
+        if 'Set-Cookie' in response.headers:
+            return False
+        content_length = response.getheader('Content-Length')
+        return content_length is not None and content_length.isdigit() and int(content_length) <= self.max_size
+
+    def close(self, flight, complete=False):
+        """finish a flight, later identical requests start a new one"""
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.close(complete)
+
+
 class Common(object):
     """Global Config Object"""
 
@@ -897,10 +2561,12 @@ class Common(object):
         self.GAE_APPIDS = re.findall('[\w\-\.]+', self.CONFIG.get('gae', 'appid').replace('.appspot.com', ''))
         self.GAE_PASSWORD = self.CONFIG.get('gae', 'password').strip()
         self.GAE_PATH = self.CONFIG.get('gae', 'path')
+        self.GAE_QUOTA = self.CONFIG.getint('gae', 'quota') if self.CONFIG.has_option('gae', 'quota') else 0
         self.GAE_PROFILE = self.CONFIG.get('gae', 'profile')
         self.GAE_CRLF = self.CONFIG.getint('gae', 'crlf')
         self.GAE_VALIDATE = self.CONFIG.getint('gae', 'validate')
         self.GAE_OBFUSCATE = self.CONFIG.getint('gae', 'obfuscate') if self.CONFIG.has_option('gae', 'obfuscate') else 0
+        self.GAE_HEDGE = self.CONFIG.getfloat('gae', 'hedge') if self.CONFIG.has_option('gae', 'hedge') else 0
 
         self.PAC_ENABLE = self.CONFIG.getint('pac', 'enable')
         self.PAC_IP = self.CONFIG.get('pac', 'ip')
@@ -952,6 +2618,20 @@ class Common(object):
         self.AUTORANGE_WAITSIZE = self.CONFIG.getint('autorange', 'waitsize')
         self.AUTORANGE_BUFSIZE = self.CONFIG.getint('autorange', 'bufsize')
         self.AUTORANGE_THREADS = self.CONFIG.getint('autorange', 'threads')
+        self.AUTORANGE_MAXTHREADS = self.CONFIG.getint('autorange', 'maxthreads') if self.CONFIG.has_option('autorange', 'maxthreads') else self.AUTORANGE_THREADS
+        self.AUTORANGE_MINSIZE = self.CONFIG.getint('autorange', 'minsize') if self.CONFIG.has_option('autorange', 'minsize') else self.AUTORANGE_MAXSIZE
+        self.AUTORANGE_SPEED = self.CONFIG.getint('autorange', 'speed') if self.CONFIG.has_option('autorange', 'speed') else 0
+        self.AUTORANGE_STOREDIR = self.CONFIG.get('autorange', 'storedir') if self.CONFIG.has_option('autorange', 'storedir') else ''
+        self.AUTORANGE_STORESIZE = self.CONFIG.getint('autorange', 'storesize') if self.CONFIG.has_option('autorange', 'storesize') else 0
+
+        self.RELAY_BUFSIZE = self.CONFIG.getint('relay', 'bufsize') if self.CONFIG.has_option('relay', 'bufsize') else 0
+        self.RELAY_TUNNELTHREADS = self.CONFIG.getint('relay', 'tunnelthreads') if self.CONFIG.has_option('relay', 'tunnelthreads') else 0
+        self.RELAY_SPLICE = self.CONFIG.getint('relay', 'splice') if self.CONFIG.has_option('relay', 'splice') else 0
+
+        self.CACHE_ENABLE = self.CONFIG.getint('cache', 'enable') if self.CONFIG.has_option('cache', 'enable') else 0
+        self.CACHE_DIR = self.CONFIG.get('cache', 'dir') if self.CONFIG.has_option('cache', 'dir') else 'cache'
+        self.CACHE_SIZE = self.CONFIG.getint('cache', 'size') if self.CONFIG.has_option('cache', 'size') else 0
+        self.CACHE_MAXOBJECT = self.CONFIG.getint('cache', 'maxobject') if self.CONFIG.has_option('cache', 'maxobject') else 0
 
         self.FETCHMAX_LOCAL = self.CONFIG.getint('fetchmax', 'local') if self.CONFIG.get('fetchmax', 'local') else 3
         self.FETCHMAX_SERVER = self.CONFIG.get('fetchmax', 'server')
@@ -965,6 +2645,18 @@ class Common(object):
         else:
             self.DNS_ENABLE = 0
 
+        if self.CONFIG.has_section('scan'):
+            self.SCAN_ENABLE = self.CONFIG.getint('scan', 'enable')
+            self.SCAN_RANGES = [x for x in self.CONFIG.get('scan', 'ranges').split('|') if x]
+            self.SCAN_THREADS = self.CONFIG.getint('scan', 'threads')
+            self.SCAN_RATE = self.CONFIG.getfloat('scan', 'rate')
+            if self.SCAN_RATE < 0:
+                logging.warning('[scan]rate = %s is negative, scan without rate limit', self.SCAN_RATE)
+                self.SCAN_RATE = 0
+            self.SCAN_POOLSIZE = self.CONFIG.getint('scan', 'poolsize')
+        else:
+            self.SCAN_ENABLE = 0
+
         if self.CONFIG.has_section('light'):
             self.LIGHT_ENABLE = self.CONFIG.getint('light', 'enable')
             self.LIGHT_PASSWORD = self.CONFIG.get('light', 'password')
@@ -998,15 +2690,28 @@ class Common(object):
         info += 'GAE APPID          : %s\n' % '|'.join(self.GAE_APPIDS)
         info += 'GAE Validate       : %s\n' % self.GAE_VALIDATE if self.GAE_VALIDATE else ''
         info += 'GAE Obfuscate      : %s\n' % self.GAE_OBFUSCATE if self.GAE_OBFUSCATE else ''
+        info += 'GAE Hedge          : %s\n' % self.GAE_HEDGE if self.GAE_HEDGE else ''
         if common.PAC_ENABLE:
             info += 'Pac Server         : http://%s:%d/%s\n' % (self.PAC_IP, self.PAC_PORT, self.PAC_FILE)
             info += 'Pac File           : file://%s\n' % os.path.join(os.path.dirname(os.path.abspath(__file__)), self.PAC_FILE).replace('\\', '/')
+        if common.AUTORANGE_MAXTHREADS > common.AUTORANGE_THREADS or common.AUTORANGE_MINSIZE < common.AUTORANGE_MAXSIZE:
+            info += 'AutoRange Threads  : %d-%d\n' % (common.AUTORANGE_THREADS, common.AUTORANGE_MAXTHREADS)
+            info += 'AutoRange Size     : %d-%d\n' % (common.AUTORANGE_MINSIZE, common.AUTORANGE_MAXSIZE)
+        if common.AUTORANGE_STOREDIR:
+            info += 'AutoRange Store    : %s\n' % common.AUTORANGE_STOREDIR
+        if common.CACHE_ENABLE:
+            info += 'HTTP Cache         : %s\n' % common.CACHE_DIR
+        if common.RELAY_TUNNELTHREADS:
+            info += 'Tunnel Threads     : %d%s\n' % (common.RELAY_TUNNELTHREADS, ' (splice)' if common.RELAY_SPLICE else '')
         if common.PAAS_ENABLE:
             info += 'PAAS Listen        : %s\n' % common.PAAS_LISTEN
             info += 'PAAS FetchServer   : %s\n' % common.PAAS_FETCHSERVER
         if common.DNS_ENABLE:
             info += 'DNS Listen         : %s\n' % common.DNS_LISTEN
             info += 'DNS Remote         : %s\n' % common.DNS_REMOTE
+        if common.SCAN_ENABLE:
+            info += 'Scan Ranges        : %s\n' % '|'.join(common.SCAN_RANGES)
+            info += 'Scan Rate          : %s\n' % ('%s/s' % common.SCAN_RATE if common.SCAN_RATE else 'unlimited')
         if common.LIGHT_ENABLE:
             info += 'LIGHT Listen       : %s\n' % common.LIGHT_LISTEN
             info += 'LIGHT Server       : %s\n' % common.LIGHT_SERVER
@@ -1014,7 +2719,10 @@ class Common(object):
         return info
 
 common = Common()
-http_util = HTTPUtil(max_window=common.GOOGLE_WINDOW, ssl_validate=common.GAE_VALIDATE or common.PAAS_VALIDATE, proxy=common.proxy)
+http_util = HTTPUtil(max_window=common.GOOGLE_WINDOW, ssl_validate=common.GAE_VALIDATE or common.PAAS_VALIDATE, proxy=common.proxy, relay_bufsize=common.RELAY_BUFSIZE, tunnel_threads=common.RELAY_TUNNELTHREADS, relay_splice=common.RELAY_SPLICE)
+appid_scheduler = AppidScheduler(common.GAE_APPIDS, daily_bytes=common.GAE_QUOTA)
+request_hedger = RequestHedger(budget_ratio=common.GAE_HEDGE, http_util=http_util)
+urlfetch_flights = URLFetchFlights()
 
 
 def message_html(self, title, banner, detail=''):
@@ -1052,15 +2760,169 @@ def message_html(self, title, banner, detail=''):
     return template
 
 
-def gae_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
-    # deflate = lambda x:zlib.compress(x)[2:-4]
-    if payload:
+class RequestBodyReader(object):
+    """Streaming Reader of a client request body, by Content-Length or chunked Transfer-Encoding"""
+
+    bufsize = 64*1024
+
+    def __init__(self, rfile, content_length=None):
+        self.rfile = rfile
+        # None for a chunked body
+        self.remaining = content_length
+        self.chunk_left = 0
+        self.done = content_length == 0
+        self.consumed = 0
+
+    def _read_chunk(self, size):
+        if not self.chunk_left:
+            line = self.rfile.readline(65537)
+            try:
+                chunk_size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise EOFError('bad chunk size line %r after %d bytes' % (line[:32], self.consumed))
+            if chunk_size == 0:
+                # skip the trailer headers
+                while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.done = True
+                return b''
+            self.chunk_left = chunk_size
+        data = self.rfile.read(min(size, self.chunk_left))
+        if not data:
+            raise EOFError('request body closed after %d bytes' % self.consumed)
+        self.chunk_left -= len(data)
+        if not self.chunk_left:
+            self.rfile.readline(65537)
+        return data
+
+    def read(self, size=-1):
+        if self.done:
+            return b''
+        if size < 0:
+            size = self.bufsize
+        if self.remaining is None:
+            data = self._read_chunk(size)
+        else:
+            data = self.rfile.read(min(size, self.remaining))
+            if not data:
+                raise EOFError('request body closed after %d bytes' % self.consumed)
+            self.remaining -= len(data)
+            self.done = not self.remaining
+        self.consumed += len(data)
+        return data
+
+
+class ChunkedPayload(object):
+    """Re-encode a RequestBodyReader as chunked Transfer-Encoding for HTTPUtil.request"""
+
+    def __init__(self, body):
+        self.body = body
+        self.done = False
+
+    @property
+    def consumed(self):
+        return self.body.consumed
+
+    def read(self, size=-1):
+        if self.done:
+            return b''
+        data = self.body.read(size)
+        if not data:
+            self.done = True
+            return b'0\r\n\r\n'
+        return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+class StreamPayload(object):
+    """Upload Payload of a known length made of bytes and file objects, read by HTTPUtil.request in chunks"""
+
+    def __init__(self, parts, length):
+        self.parts = collections.deque(parts)
+        self.length = length
+        self.consumed = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size < 0:
+            size = RequestBodyReader.bufsize
+        while self.parts:
+            part = self.parts[0]
+            if isinstance(part, bytes):
+                data = part[:size]
+                if len(part) > size:
+                    self.parts[0] = part[size:]
+                else:
+                    self.parts.popleft()
+            else:
+                data = part.read(size)
+                if not data:
+                    self.parts.popleft()
+                    if hasattr(part, 'close'):
+                        # spooled temporary file, the client rfile of a RequestBodyReader stays with its handler
+                        part.close()
+                    continue
+            self.consumed += len(data)
+            return data
+        return b''
+
+    def prepend(self, data):
+        self.parts.appendleft(data)
+        self.length += len(data)
+        return self
+
+
+def deflate_payload(payload, headers, spool_size=1024*1024):
+    """deflate payload and set Content-Length in headers, return the payload to send
+
+    a bytes payload is compressed in one go, a RequestBodyReader is compressed by a zlib.compressobj into a spooled
+    temporary file when its head compresses well, a body of known length that does not is sent as it is read.
+    """
+    def set_header(name, value):
+        # headers may be a http.client.HTTPMessage, where item assignment appends
+        if name in headers:
+            del headers[name]
+        headers[name] = value
+    if isinstance(payload, bytes):
         if len(payload) < 10 * 1024 * 1024 and 'Content-Encoding' not in headers:
             zpayload = zlib.compress(payload)[2:-4]
             if len(zpayload) < len(payload):
                 payload = zpayload
-                headers['Content-Encoding'] = 'deflate'
-        headers['Content-Length'] = str(len(payload))
+                set_header('Content-Encoding', 'deflate')
+        set_header('Content-Length', str(len(payload)))
+        return payload
+    if 'Transfer-Encoding' in headers:
+        del headers['Transfer-Encoding']
+    head = b''
+    while len(head) < payload.bufsize:
+        data = payload.read(payload.bufsize - len(head))
+        if not data:
+            break
+        head += data
+    compress = head and 'Content-Encoding' not in headers and (payload.remaining is None or payload.remaining < 10 * 1024 * 1024) and len(zlib.compress(head, 1)) < len(head) * 0.9
+    if not compress and payload.remaining is not None:
+        # incompressible body of known length goes straight to the fetchserver
+        set_header('Content-Length', str(len(head) + payload.remaining))
+        return StreamPayload([head, payload], len(head) + payload.remaining)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS) if compress else None
+    data = head
+    while data:
+        spool.write(compressor.compress(data) if compressor else data)
+        data = payload.read()
+    if compressor:
+        spool.write(compressor.flush())
+        set_header('Content-Encoding', 'deflate')
+    length = spool.tell()
+    spool.seek(0)
+    set_header('Content-Length', str(length))
+    return StreamPayload([spool], length)
+
+
+def gae_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
+    if payload:
+        payload = deflate_payload(payload, headers)
     # GAE donot allow set `Host` header
     if 'Host' in headers:
         del headers['Host']
@@ -1089,7 +2951,8 @@ def gae_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
         else:
             response = http_util.request('POST', fetchserver, payload, {'Cookie': cookie, 'Content-Length': str(len(payload))}, crlf=need_crlf)
     else:
-        payload = b''.join((struct.pack('!h', len(metadata)), metadata, payload))
+        prefix = struct.pack('!h', len(metadata)) + metadata
+        payload = payload.prepend(prefix) if isinstance(payload, StreamPayload) else prefix + payload
         response = http_util.request('POST', fetchserver, payload, {'Content-Length': str(len(payload))}, crlf=need_crlf)
     response.app_status = response.status
     if response.status != 200:
@@ -1112,16 +2975,388 @@ def gae_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
     return response
 
 
+class RangeBuffer(object):
+    """Offset Indexed Reorder Buffer of RangeFetch"""
+
+    max_size = 1024*1024*32
+
+    def __init__(self, begin, max_size=0):
+        self.begin = begin
+        self.max_size = max_size or self.__class__.max_size
+        # offset -> data, size counts the bytes actually buffered
+        self.chunks = {}
+        self.size = 0
+        # bytes of started ranges not put yet, counted against max_size so a put never has to block
+        self.reserved = 0
+        self.closed = False
+        self.stall_time = 0
+        self.condition = threading.Condition()
+
+    def put(self, offset, data):
+        """buffer data at offset, return False when the consumer is gone"""
+        with self.condition:
+            if self.closed:
+                return False
+            self.reserved = max(self.reserved - len(data), 0)
+            if offset >= self.begin:
+                self.chunks[offset] = data
+                self.size += len(data)
+                if offset == self.begin:
+                    self.condition.notify_all()
+            return True
+
+    def wait_writable(self, offset, size, timeout=None):
+        """block the producer until a range of size bytes at offset fits in max_size and reserve it, the range needed by the consumer right now always passes"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.size + self.reserved + size <= self.max_size or offset <= self.begin, timeout)
+            if self.closed:
+                return False
+            self.reserved += size
+            return True
+
+    def release(self, size):
+        """give back the reservation of a range ended short"""
+        with self.condition:
+            if not self.closed:
+                self.reserved = max(self.reserved - size, 0)
+                self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """return data at the next offset, or None when timed out or closed"""
+        with self.condition:
+            if self.begin not in self.chunks and not self.closed:
+                wait_time = time.time()
+                self.condition.wait_for(lambda: self.begin in self.chunks or self.closed, timeout)
+                self.stall_time += time.time() - wait_time
+            data = self.chunks.pop(self.begin, None)
+            if data is None:
+                return None
+            self.begin += len(data)
+            self.size -= len(data)
+            self.condition.notify_all()
+            return data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.chunks.clear()
+            self.size = self.reserved = 0
+            self.condition.notify_all()
+
+
+class RangeStoreEntry(object):
+    """Sparse File of One Range Stored Object"""
+
+    def __init__(self, key, path, url, etag, last_modified, length, ranges=None):
+        self.key = key
+        self.path = path
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.length = length
+        # sorted and merged [start, end) spans already on disk
+        self.ranges = ranges or []
+        self.size = sum(end - start for start, end in self.ranges)
+        self.refs = 0
+        # [start, end) spans being fetched, shared by all RangeFetch reading this entry
+        self.claims = []
+        # span start -> [end, failures, not_before] of failed fetches, the span is not claimed again before not_before
+        self.backoffs = {}
+        # set when a span failed for good, every RangeFetch reading this entry gives up
+        self.error = None
+        self.file = None
+        self.mmap = None
+        self.condition = threading.Condition()
+
+    def open(self):
+        if self.mmap is None:
+            self.file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+            self.file.truncate(self.length)
+            self.mmap = mmap.mmap(self.file.fileno(), self.length)
+
+    def close(self):
+        with self.condition:
+            if self.mmap is not None:
+                try:
+                    self.mmap.close()
+                except BufferError:
+                    # a client still holds a view of it, the mapping goes away with the last view
+                    pass
+                self.file.close()
+                self.mmap = self.file = None
+            # failures are forgotten with the last reader, a later request tries again
+            self.backoffs.clear()
+            self.error = None
+
+    def write(self, offset, data):
+        """write data at offset, return the count of newly stored bytes"""
+        end = offset + len(data)
+        with self.condition:
+            if self.mmap is None:
+                return 0
+            self.mmap[offset:end] = data
+            i = bisect.bisect_right(self.ranges, [offset, float('inf')])
+            if i and self.ranges[i-1][1] >= offset:
+                i -= 1
+            j = i
+            new_start, new_end = offset, end
+            while j < len(self.ranges) and self.ranges[j][0] <= end:
+                new_start, new_end = min(new_start, self.ranges[j][0]), max(new_end, self.ranges[j][1])
+                j += 1
+            added = (new_end - new_start) - sum(e - s for s, e in self.ranges[i:j])
+            self.ranges[i:j] = [[new_start, new_end]]
+            self.size += added
+            for start in [x for x in self.backoffs if offset <= x < end]:
+                del self.backoffs[start]
+            self.condition.notify_all()
+        return added
+
+    def covered_end(self, offset):
+        """end of the stored span containing offset, offset itself when not stored"""
+        i = bisect.bisect_right(self.ranges, [offset, float('inf')])
+        if i and self.ranges[i-1][0] <= offset < self.ranges[i-1][1]:
+            return self.ranges[i-1][1]
+        return offset
+
+    def claim_span(self, start, end):
+        with self.condition:
+            self.claims.append([start, end])
+
+    def claim(self, offset, size, stopped):
+        """claim the first span missing, unclaimed and not backing off at or after offset, wait while others hold the rest, None when all stored or failed"""
+        with self.condition:
+            while not stopped() and not self.error:
+                now = time.time()
+                # spans backing off count as claimed until their not_before
+                busy = self.claims + [[k, v[0]] for k, v in self.backoffs.items() if v[2] > now]
+                start = offset
+                while start < self.length:
+                    start = self.covered_end(start)
+                    claim = next((x for x in busy if x[0] <= start < x[1]), None)
+                    if not claim:
+                        break
+                    start = claim[1]
+                if start < self.length:
+                    i = bisect.bisect_right(self.ranges, [start, float('inf')])
+                    end = min([start + size, self.length] + [x[0] for x in self.ranges[i:i+1]] + [x[0] for x in busy if x[0] > start])
+                    self.claims.append([start, end])
+                    return start, end
+                if not any(x[1] > offset for x in busy):
+                    return None
+                not_before = [v[2] for k, v in self.backoffs.items() if v[0] > offset and v[2] > now]
+                self.condition.wait(min(not_before) - now if not_before else None)
+            return None
+
+    def backoff(self, start, end, delay):
+        """count a failed fetch of [start, end), keep it unclaimed for delay seconds doubled per failure, return its failures"""
+        with self.condition:
+            failures = self.backoffs.get(start, [0, 0, 0])[1] + 1
+            self.backoffs[start] = [end, failures, time.time() + delay * 2 ** (failures - 1)]
+            return failures
+
+    def fail(self, reason):
+        with self.condition:
+            self.error = self.error or reason
+            self.condition.notify_all()
+
+    def release_claim(self, start, end):
+        with self.condition:
+            self.claims.remove([start, end])
+            self.condition.notify_all()
+
+    def validates(self, response):
+        """whether a range response is of the stored version, a changed object must not mix into the stored ranges"""
+        etag = response.getheader('ETag', '')
+        last_modified = response.getheader('Last-Modified', '')
+        length = response.getheader('Content-Range', '').rpartition('/')[2]
+        return (not etag or etag == self.etag) and (not last_modified or last_modified == self.last_modified) and length in ('', '*', str(self.length))
+
+    def meta(self):
+        return {'url': self.url, 'etag': self.etag, 'last_modified': self.last_modified, 'length': self.length, 'ranges': self.ranges}
+
+
+class RangeStore(object):
+    """Disk Backed Resumable Store of RangeFetch, objects keyed by url and validators, lru evicted under a global quota"""
+
+    max_size = 1024*1024*1024*4
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size or self.__class__.max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    def load(self):
+        for filename in sorted(glob.glob(os.path.join(self.directory, '*.json')), key=os.path.getmtime):
+            key = os.path.basename(filename)[:-5]
+            try:
+                with open(filename, 'r') as fp:
+                    meta = json.load(fp)
+                entry = RangeStoreEntry(key, os.path.join(self.directory, key), meta['url'], meta['etag'], meta['last_modified'], meta['length'], meta['ranges'])
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning('RangeStore load %r failed: %r', filename, e)
+                continue
+            self.entries[key] = entry
+            self.size += entry.size
+        self.evict()
+        logging.info('RangeStore loaded %d objects, %d bytes from %r', len(self.entries), self.size, self.directory)
+
+    def open(self, url, headers, length):
+        """return a referenced entry of url, or None when it cannot be validated later"""
+        etag = headers.get('Etag', '')
+        last_modified = headers.get('Last-Modified', '')
+        if not (etag or last_modified) or not 0 < length <= self.max_size:
+            return None
+        key = hashlib.sha1(('%s\n%s\n%s\n%d' % (url, etag, last_modified, length)).encode('utf-8')).hexdigest()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = RangeStoreEntry(key, os.path.join(self.directory, key), url, etag, last_modified, length)
+                self.stats['miss'] += 1
+            else:
+                self.stats['hit' if entry.size == length else 'partial'] += 1
+            self.entries[key] = entry
+            entry.refs += 1
+            if entry.refs > 1:
+                # an in-flight download of the same object, read along with it
+                self.stats['attach'] += 1
+        try:
+            entry.open()
+        except (OSError, ValueError) as e:
+            logging.warning('RangeStore open %r failed: %r', entry.path, e)
+            self.release(entry)
+            return None
+        return entry
+
+    def write(self, entry, offset, data):
+        added = entry.write(offset, data)
+        if added:
+            with self.lock:
+                if self.entries.get(entry.key) is not entry:
+                    # discarded while its readers still write
+                    return
+                self.size += added
+            if self.size > self.max_size:
+                self.evict()
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs:
+                return
+            entry.close()
+            # saved under the lock, an evict or discard in between would leave a meta of removed data behind
+            if self.entries.get(entry.key) is entry:
+                try:
+                    with open(entry.path + '.json.tmp', 'w') as fp:
+                        json.dump(entry.meta(), fp)
+                    os.replace(entry.path + '.json.tmp', entry.path + '.json')
+                except OSError as e:
+                    logging.warning('RangeStore save %r failed: %r', entry.path, e)
+
+    def discard(self, entry):
+        """drop an entry whose object changed upstream, its readers keep the mapping until released"""
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                return
+            del self.entries[entry.key]
+            self.size -= entry.size
+            self.stats['discard'] += 1
+            self._remove(entry)
+
+    def evict(self):
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if self.size <= self.max_size:
+                    break
+                if entry.refs:
+                    continue
+                del self.entries[key]
+                self.size -= entry.size
+                self.stats['evict'] += 1
+                self._remove(entry)
+
+    def _remove(self, entry):
+        for filename in (entry.path, entry.path + '.json'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class RangeStoreReader(object):
+    """Reorder Buffer of RangeFetch over a RangeStoreEntry, the same interface as RangeBuffer"""
+
+    max_read = 1024*256
+
+    def __init__(self, store, entry, begin):
+        self.store = store
+        self.entry = entry
+        self.begin = begin
+        self.closed = False
+        self.stall_time = 0
+
+    def put(self, offset, data):
+        if self.closed:
+            return False
+        self.store.write(self.entry, offset, data)
+        return True
+
+    def wait_writable(self, offset, size, timeout=None):
+        # disk is bounded by the store quota, never hold the producers back
+        return not self.closed
+
+    def release(self, size):
+        pass
+
+    def get(self, timeout=None):
+        """return a view of the stored data at the next offset, or None when timed out or closed"""
+        entry = self.entry
+        with entry.condition:
+            if entry.covered_end(self.begin) == self.begin and not self.closed:
+                wait_time = time.time()
+                entry.condition.wait_for(lambda: entry.covered_end(self.begin) > self.begin or self.closed or entry.error, timeout)
+                self.stall_time += time.time() - wait_time
+            if self.closed:
+                return None
+            end = min(entry.covered_end(self.begin), self.begin + self.max_read)
+        if end == self.begin:
+            return None
+        data = memoryview(entry.mmap)[self.begin:end]
+        self.begin = end
+        return data
+
+    def close(self):
+        with self.entry.condition:
+            self.closed = True
+            self.entry.condition.notify_all()
+
+
 class RangeFetch(object):
     """Range Fetch Class"""
 
     maxsize = 1024*1024*4
+    minsize = 1024*256
     bufsize = 8192
     threads = 1
+    maxthreads = 0
     waitsize = 1024*512
+    target_speed = 0
+    chunk_time = 4
+    timeout = 90
+    max_buffer_size = 1024*1024*32
+    max_retries = 4
+    retry_delay = 1
+    retry_statuses = (408, 429, 500, 502, 503, 504)
+    store = None
     urlfetch = staticmethod(gae_urlfetch)
 
-    def __init__(self, wfile, response, method, url, headers, payload, fetchservers, password, maxsize=0, bufsize=0, waitsize=0, threads=0):
+    def __init__(self, wfile, response, method, url, headers, payload, fetchservers, password, maxsize=0, bufsize=0, waitsize=0, threads=0, minsize=0, maxthreads=0, target_speed=0, scheduler=None):
         self.wfile = wfile
         self.response = response
         self.command = method
@@ -1131,11 +3366,31 @@ class RangeFetch(object):
         self.fetchservers = fetchservers
         self.password = password
         self.maxsize = maxsize or self.__class__.maxsize
+        self.minsize = min(minsize or self.__class__.minsize, self.maxsize)
         self.bufsize = bufsize or self.__class__.bufsize
-        self.waitsize = waitsize or self.__class__.bufsize
+        self.waitsize = waitsize or self.__class__.waitsize
         self.threads = threads or self.__class__.threads
+        self.maxthreads = max(maxthreads or self.__class__.maxthreads, self.threads)
+        self.target_speed = target_speed or self.__class__.target_speed
+        # appid -> fetchserver, chosen by the scheduler when given, else at random
+        self.scheduler = scheduler
+        self._appid_fetchservers = dict((urllib.parse.urlsplit(x).hostname.partition('.')[0], x) for x in fetchservers)
         self._stopped = None
         self._last_app_status = {}
+        # tuned while fetching within [minsize, maxsize] and [1, maxthreads]
+        self.chunksize = self.maxsize
+        self.active_threads = self.threads
+        self.throughput = 0
+        self.fetchserver_stats = collections.defaultdict(collections.Counter)
+        self._fetchlets = 0
+        self._good_chunks = 0
+        self._waited = False
+        self._store_entry = None
+        # range start -> failures in memory mode, a range making progress starts over at its new start
+        self._retries = collections.Counter()
+        self._error = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
 
     def fetch(self):
         response_status = self.response.status
@@ -1153,124 +3408,585 @@ class RangeFetch(object):
         logging.info('>>>>>>>>>>>>>>> RangeFetch started(%r) %d-%d', self.url, start, end)
         self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response_status, ''.join('%s: %s\r\n' % (k, v) for k, v in response_headers.items()))).encode('latin-1'))
 
-        data_queue = queue.PriorityQueue()
-        range_queue = queue.PriorityQueue()
-        range_queue.put((start, end, self.response))
-        for begin in range(end+1, length, self.maxsize):
-            range_queue.put((begin, min(begin+self.maxsize-1, length-1), None))
-        for i in range(self.threads):
-            threading._start_new_thread(self.__fetchlet, (range_queue, data_queue))
-        has_peek = hasattr(data_queue, 'peek')
-        peek_timeout = 90
+        self._store_entry = self.store.open(self.url, response_headers, length) if self.store else None
+        if self._store_entry:
+            self._data_buffer = RangeStoreReader(self.store, self._store_entry, start)
+            logging.info('RangeFetch use store(%r) %d/%d bytes stored, %d readers', self._store_entry.path, self._store_entry.size, length, self._store_entry.refs)
+        else:
+            self._data_buffer = RangeBuffer(start, self.max_buffer_size)
+        self._range_queue = queue.PriorityQueue()
+        self._range_queue.put((start, end, self.response))
+        if self._store_entry:
+            self._store_entry.claim_span(start, end+1)
+        self._next_begin = end + 1
+        self._length = length
+        # fan out after the first waitsize bytes arrived, a failing url costs one request only
+        self._spawn_fetchlets()
         expect_begin = start
-        while expect_begin < length-1:
+        try:
+            while expect_begin < length:
+                data = self._data_buffer.get(timeout=self.timeout)
+                if data is None:
+                    if self._store_entry and self._store_entry.error:
+                        # another fetch of the entry gave up
+                        self._abort(self._store_entry.error)
+                    if not self._error:
+                        logging.error('RangeFetch data_buffer get timeout, break')
+                    break
+                try:
+                    self.wfile.write(data)
+                    expect_begin += len(data)
+                except OSError as e:
+                    logging.info('RangeFetch client connection aborted(%s).', e)
+                    break
+                if not self._waited and expect_begin - start >= self.waitsize:
+                    self._waited = True
+                    self._spawn_fetchlets()
+        finally:
+            with self._lock:
+                self._stopped = True
+                fetchlets = self._fetchlets
+            self._stop_event.set()
+            self._data_buffer.close()
+            # wake up the fetchlets waiting for ranges, they quit on _stopped, maxthreads may have shrunk below their count
+            for i in range(fetchlets):
+                self._range_queue.put((length+i, 0, None))
+            if self._store_entry:
+                self.store.release(self._store_entry)
+        logging.info('RangeFetch finished(%r) %d bytes, stalled %.2fs, threads=%d chunksize=%d throughput=%.1fKB/s fetchservers=%s', self.url, expect_begin-start, self._data_buffer.stall_time, self.active_threads, self.chunksize, self.throughput/1024, dict(self.fetchserver_stats))
+
+    def _spawn_fetchlets(self):
+        with self._lock:
+            count = (self.active_threads if self._waited else 1) - self._fetchlets
+            if count <= 0 or self._stopped:
+                return
+            self._fetchlets += count
+        for i in range(count):
+            threading._start_new_thread(self.__fetchlet, (self._range_queue, self._data_buffer))
+
+    def _next_range(self, range_queue):
+        """retried ranges first, then carve a new range of current chunksize, block for retries when all carved"""
+        with self._lock:
+            if self._fetchlets > self.active_threads:
+                self._fetchlets -= 1
+                return None
             try:
-                if has_peek:
-                    begin, data = data_queue.peek(timeout=peek_timeout)
-                    if expect_begin == begin:
-                        data_queue.get()
-                    elif expect_begin < begin:
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        logging.error('RangeFetch Error: begin(%r) < expect_begin(%r), quit.', begin, expect_begin)
-                        break
-                else:
-                    begin, data = data_queue.get(timeout=peek_timeout)
-                    if expect_begin == begin:
-                        pass
-                    elif expect_begin < begin:
-                        data_queue.put((begin, data))
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        logging.error('RangeFetch Error: begin(%r) < expect_begin(%r), quit.', begin, expect_begin)
-                        break
+                return range_queue.get_nowait()
             except queue.Empty:
-                logging.error('data_queue peek timeout, break')
-                break
-            try:
-                self.wfile.write(data)
-                expect_begin += len(data)
-            except OSError as e:
-                logging.info('RangeFetch client connection aborted(%s).', e)
-                break
-        self._stopped = True
-
-    def __fetchlet(self, range_queue, data_queue):
+                pass
+            if not self._store_entry and self._next_begin < self._length:
+                begin = self._next_begin
+                self._next_begin = min(begin + self.chunksize, self._length)
+                return begin, self._next_begin - 1, None
+        if self._store_entry:
+            # claim what the store is missing and nobody is fetching, from where our client reads
+            span = self._store_entry.claim(self._data_buffer.begin, self.chunksize, lambda: self._stopped)
+            return (span[0], span[1]-1, None) if span else None
+        return range_queue.get()
+
+    def _retry(self, range_queue, start, end):
+        """retry a failed range after a backoff doubling with its failures, abort the fetch when it failed max_retries times"""
+        if self._store_entry:
+            # failures are counted on the entry and shared with every fetch reading it, the released claim backs off there
+            retries = self._store_entry.backoff(start, end+1, self.retry_delay)
+        else:
+            with self._lock:
+                self._retries[start] += 1
+                retries = self._retries[start]
+        if retries > self.max_retries:
+            self._abort('range %d-%d failed %d times' % (start, end, retries))
+            return
+        # back off in this fetchlet as well, so it does not go on to fail the next ranges meanwhile
+        if not self._stop_event.wait(self.retry_delay * 2 ** (retries - 1)) and not self._store_entry:
+            range_queue.put((start, end, None))
+
+    def _abort(self, reason):
+        """give up the whole fetch, the client gets a truncated response instead of waiting for the timeout"""
+        with self._lock:
+            if self._error:
+                return
+            self._error = reason
+        logging.error('RangeFetch "%s %s" aborted: %s', self.command, self.url, reason)
+        if self._store_entry:
+            self._store_entry.fail(reason)
+        self._data_buffer.close()
+
+    def _adjust(self, fetchserver, size, elapsed, status):
+        """tune chunksize and active_threads by the result of one range request, status 0 means a broken transfer"""
+        with self._lock:
+            stats = self.fetchserver_stats[fetchserver]
+            stats['requests'] += 1
+            stats['bytes'] += size
+            old_values = (self.active_threads, self.chunksize)
+            if status == 200:
+                speed = size / max(elapsed, 0.001)
+                self.throughput = speed if not self.throughput else self.throughput * 0.7 + speed * 0.3
+                # ranges of about chunk_time seconds keep the per-request latency small against the transfer, grow back slowly after failures
+                chunksize = int(self.throughput * self.chunk_time) // self.bufsize * self.bufsize
+                self.chunksize = min(max(chunksize, self.minsize), self.maxsize, self.chunksize + self.minsize)
+                self._good_chunks += 1
+                if self.target_speed and self.throughput * (self.active_threads - 1) >= self.target_speed:
+                    self.active_threads -= 1
+                    self._good_chunks = 0
+                elif self._good_chunks >= self.active_threads and self.active_threads < self.maxthreads and not (self.target_speed and self.throughput * self.active_threads >= self.target_speed):
+                    self.active_threads += 1
+                    self._good_chunks = 0
+            elif status >= 500:
+                # 503 over quota, halve the concurrency and never grow back to where it tripped during this fetch
+                stats['errors'] += 1
+                self.maxthreads = max(1, min(self.maxthreads, self.active_threads - 1))
+                self.active_threads = max(1, self.active_threads // 2)
+                self._good_chunks = 0
+            else:
+                # broken transfers get more likely with big ranges
+                stats['errors'] += 1
+                self.chunksize = max(self.minsize, self.chunksize // 2 // self.bufsize * self.bufsize)
+                self._good_chunks = 0
+            changed = (self.active_threads, self.chunksize) != old_values
+        if changed:
+            logging.info('RangeFetch adjust(%r) threads=%d chunksize=%d throughput=%.1fKB/s', self.url, self.active_threads, self.chunksize, self.throughput/1024)
+            self._spawn_fetchlets()
+
+    def __fetchlet(self, range_queue, data_buffer):
         headers = copy.copy(self.headers)
         headers['Connection'] = 'close'
+        if self._store_entry:
+            # a changed object answers the whole body instead of a range, weak etags are not allowed here
+            validator = self._store_entry.etag if not self._store_entry.etag.startswith('W/') else self._store_entry.last_modified
+            if validator:
+                headers['If-Range'] = validator
         while 1:
             try:
-                if self._stopped:
+                item = self._next_range(range_queue)
+                if not item:
                     return
-                if data_queue.qsize() * self.bufsize > 180*1024*1024:
-                    time.sleep(10)
-                    continue
+                start, end, response = item
+                # in store mode every range but the quit sentinels is claimed on the shared entry, so concurrent fetches of it skip this span
+                claim = (start, end+1) if self._store_entry and start < self._length else None
+                reserved_end = start
                 try:
-                    start, end, response = range_queue.get(timeout=1)
-                    headers['Range'] = 'bytes=%d-%d' % (start, end)
-                    fetchserver = ''
+                    if self._stopped or not data_buffer.wait_writable(start, end + 1 - start):
+                        if response:
+                            response.close()
+                        return
+                    reserved_end = end + 1
+                    if response and self._store_entry and self._store_entry.covered_end(start) > end:
+                        response.close()
+                        continue
+                    request_time = time.time()
+                    try:
+                        headers['Range'] = 'bytes=%d-%d' % (start, end)
+                        fetchserver = appid = ''
+                        if not response:
+                            if self.scheduler:
+                                cooldown = self.scheduler.cooldown(list(self._appid_fetchservers))
+                                # the client waits for the next range up to timeout anyway
+                                if cooldown > self.timeout:
+                                    self._abort('all appids cooling down for %ds' % cooldown)
+                                    return
+                                elif cooldown and self._stop_event.wait(cooldown):
+                                    return
+                                appid = self.scheduler.choose(list(self._appid_fetchservers))
+                                fetchserver = self._appid_fetchservers[appid]
+                            else:
+                                fetchserver = random.choice(self.fetchservers)
+                                if self._last_app_status.get(fetchserver, 200) >= 500:
+                                    time.sleep(5)
+                            try:
+                                response = self.urlfetch(self.command, self.url, headers, self.payload, fetchserver, password=self.password)
+                            finally:
+                                if appid:
+                                    self.scheduler.record(appid, response.app_status if response else 0, time.time() - request_time)
+                    except OSError as e:
+                        logging.warning("Response %r in __fetchlet", e)
                     if not response:
-                        fetchserver = random.choice(self.fetchservers)
-                        if self._last_app_status.get(fetchserver, 200) >= 500:
-                            time.sleep(5)
-                        response = self.urlfetch(self.command, self.url, headers, self.payload, fetchserver, password=self.password)
-                except queue.Empty:
-                    continue
-                except OSError as e:
-                    logging.warning("Response %r in __fetchlet", e)
-                if not response:
-                    logging.warning('RangeFetch %s return %r', headers['Range'], response)
-                    range_queue.put((start, end, None))
-                    continue
-                if fetchserver:
-                    self._last_app_status[fetchserver] = response.app_status
-                if response.app_status != 200:
-                    logging.warning('Range Fetch "%s %s" %s return %s', self.command, self.url, headers['Range'], response.app_status)
-                    response.close()
-                    range_queue.put((start, end, None))
-                    continue
-                if response.getheader('Location'):
-                    self.url = response.getheader('Location')
-                    logging.info('RangeFetch Redirect(%r)', self.url)
-                    response.close()
-                    range_queue.put((start, end, None))
-                    continue
-                if 200 <= response.status < 300:
-                    content_range = response.getheader('Content-Range')
-                    if not content_range:
-                        logging.warning('RangeFetch "%s %s" return Content-Range=%r: response headers=%r', self.command, self.url, content_range, str(response.headers))
+                        logging.warning('RangeFetch %s return %r', headers['Range'], response)
+                        self._adjust(fetchserver, 0, 0, 0)
+                        self._retry(range_queue, start, end)
+                        continue
+                    if fetchserver:
+                        self._last_app_status[fetchserver] = response.app_status
+                    if response.app_status != 200:
+                        logging.warning('Range Fetch "%s %s" %s return %s', self.command, self.url, headers['Range'], response.app_status)
+                        self._adjust(fetchserver, 0, 0, response.app_status)
                         response.close()
-                        range_queue.put((start, end, None))
+                        self._retry(range_queue, start, end)
                         continue
-                    content_length = int(response.getheader('Content-Length', 0))
-                    logging.info('>>>>>>>>>>>>>>> [thread %s] %s %s', threading.currentThread().ident, content_length, content_range)
-                    while 1:
-                        try:
-                            data = response.read(self.bufsize)
-                            if not data:
+                    if response.getheader('Location'):
+                        self.url = response.getheader('Location')
+                        logging.info('RangeFetch Redirect(%r)', self.url)
+                        response.close()
+                        self._retry(range_queue, start, end)
+                        continue
+                    if 200 <= response.status < 300:
+                        if self._store_entry and not self._store_entry.validates(response):
+                            response.close()
+                            self.store.discard(self._store_entry)
+                            self._abort('%s changed, Etag=%r Last-Modified=%r' % (self.url, response.getheader('ETag'), response.getheader('Last-Modified')))
+                            return
+                        content_range = response.getheader('Content-Range')
+                        if not content_range:
+                            logging.warning('RangeFetch "%s %s" return Content-Range=%r: response headers=%r', self.command, self.url, content_range, str(response.headers))
+                            response.close()
+                            self._retry(range_queue, start, end)
+                            continue
+                        content_length = int(response.getheader('Content-Length', 0))
+                        logging.info('>>>>>>>>>>>>>>> [thread %s] %s %s', threading.currentThread().ident, content_length, content_range)
+                        range_start = start
+                        while 1:
+                            try:
+                                data = response.read(self.bufsize)
+                                if not data:
+                                    break
+                                if not data_buffer.put(start, data):
+                                    response.close()
+                                    return
+                                start += len(data)
+                                if appid:
+                                    self.scheduler.account(appid, len(data))
+                            except OSError as e:
+                                logging.warning('RangeFetch "%s %s" %s failed: %s', self.command, self.url, headers['Range'], e)
                                 break
-                            data_queue.put((start, data))
-                            start += len(data)
-                        except OSError as e:
-                            logging.warning('RangeFetch "%s %s" %s failed: %s', self.command, self.url, headers['Range'], e)
-                            break
-                    if start < end:
-                        logging.warning('RangeFetch "%s %s" retry %s-%s', self.command, self.url, start, end)
+                        if fetchserver:
+                            self._adjust(fetchserver, start - range_start, time.time() - request_time, 200 if start > end else 0)
+                        if start <= end:
+                            logging.warning('RangeFetch "%s %s" retry %s-%s', self.command, self.url, start, end)
+                            response.close()
+                            self._retry(range_queue, start, end)
+                            continue
+                    elif response.status in self.retry_statuses:
+                        logging.warning('RangeFetch "%s %s" %s return %s', self.command, self.url, headers['Range'], response.status)
                         response.close()
-                        range_queue.put((start, end, None))
+                        self._retry(range_queue, start, end)
                         continue
-                else:
-                    logging.error('RangeFetch %r return %s', self.url, response.status)
-                    response.close()
-                    #range_queue.put((start, end, None))
-                    continue
+                    else:
+                        # the origin refuses this range, every later range would fail the same
+                        response.close()
+                        self._abort('%s return %s' % (headers['Range'], response.status))
+                        return
+                finally:
+                    if claim:
+                        self._store_entry.release_claim(*claim)
+                    if reserved_end > start:
+                        data_buffer.release(reserved_end - start)
             except Exception as e:
                 logging.exception('RangeFetch._fetchlet error:%s', e)
                 raise
 
 
+class HTTPCacheEntry(object):
+    """Compact Index Entry of HTTPCache"""
+
+    __slots__ = ('key', 'size', 'response_time', 'corrected_age', 'lifetime', 'etag', 'last_modified', 'vary', 'vary_key', 'must_revalidate', 'body')
+
+    def __init__(self, key, size, response_time, corrected_age, lifetime, etag, last_modified, vary, vary_key, must_revalidate, body):
+        self.key = key
+        self.size = size
+        self.response_time = response_time
+        self.corrected_age = corrected_age
+        self.lifetime = lifetime
+        self.etag = etag
+        self.last_modified = last_modified
+        self.vary = vary
+        self.vary_key = vary_key
+        self.must_revalidate = must_revalidate
+        # file name of the body version its json refers to
+        self.body = body
+
+    def age(self, now=None):
+        return self.corrected_age + (now or time.time()) - self.response_time
+
+
+class HTTPCacheWriter(object):
+    """Tee a response body into HTTPCache, commit only when complete"""
+
+    def __init__(self, cache, entry, meta, path):
+        self.cache = cache
+        self.entry = entry
+        self.meta = meta
+        self.path = path
+        self.file = open(path + '.tmp', 'wb')
+        self.written = 0
+
+    def write(self, data):
+        if self.file:
+            self.file.write(data)
+            self.written += len(data)
+
+    def close(self):
+        if not self.file:
+            return
+        self.file.close()
+        self.file = None
+        if self.written == self.entry.size:
+            self.cache._commit(self.entry, self.meta, self.path)
+        else:
+            try:
+                os.remove(self.path + '.tmp')
+            except OSError:
+                pass
+
+
+class HTTPCache(object):
+    """Shared On-Disk HTTP Cache in front of gae_urlfetch, RFC 7234 freshness, ETag/Last-Modified revalidation and lru eviction"""
+
+    max_size = 1024*1024*256
+    max_object_size = 1024*1024*8
+    heuristic_fraction = 0.1
+    max_heuristic_lifetime = 86400
+    cacheable_status = (200, 203, 300, 301, 404, 410)
+    skip_headers = frozenset(['Connection', 'Keep-Alive', 'Proxy-Connection', 'Transfer-Encoding', 'Te', 'Trailer', 'Upgrade', 'Age'])
+
+    def __init__(self, directory, max_size=0, max_object_size=0):
+        self.directory = directory
+        self.max_size = max_size or self.__class__.max_size
+        self.max_object_size = max_object_size or self.__class__.max_object_size
+        # sha1 digest of url -> HTTPCacheEntry, in lru order
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    @staticmethod
+    def parse_cache_control(value):
+        directives = {}
+        for directive in value.split(','):
+            name, _, arg = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = arg.strip('"') if arg else True
+        return directives
+
+    @staticmethod
+    def _parse_date(value):
+        try:
+            return email.utils.mktime_tz(email.utils.parsedate_tz(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def _parse_seconds(value):
+        try:
+            return max(0, int(value))
+        except (TypeError, ValueError):
+            return None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.hex())
+
+    def _vary_key(self, vary, request_headers):
+        return hashlib.sha1('\n'.join(request_headers.get(x, '') for x in vary).encode('utf-8')).digest()[:8]
+
+    def _freshness(self, headers, request_time, response_time):
+        """return (corrected age, freshness lifetime, must revalidate) of response headers, rfc 7234 section 4.2"""
+        directives = self.parse_cache_control(headers.get('Cache-Control', ''))
+        date = self._parse_date(headers.get('Date', '')) or response_time
+        apparent_age = max(0, response_time - date)
+        corrected_age = max(apparent_age, (self._parse_seconds(headers.get('Age')) or 0) + response_time - request_time)
+        must_revalidate = 'no-cache' in directives or 'must-revalidate' in directives or 'proxy-revalidate' in directives
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                lifetime = self._parse_seconds(directives[name])
+                if lifetime is not None:
+                    return corrected_age, lifetime, must_revalidate
+        if 'Expires' in headers:
+            expires = self._parse_date(headers['Expires'])
+            return corrected_age, max(0, expires - date) if expires else 0, must_revalidate
+        last_modified = self._parse_date(headers.get('Last-Modified', ''))
+        if last_modified:
+            return corrected_age, min(max(0, date - last_modified) * self.heuristic_fraction, self.max_heuristic_lifetime), must_revalidate
+        return corrected_age, 0, must_revalidate
+
+    def load(self):
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(filename, 'r') as fp:
+                    meta = json.load(fp)
+                entries.append((os.path.getmtime(filename), self._entry(bytes.fromhex(os.path.basename(filename)[:-5]), meta)))
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning('HTTPCache load %r failed: %r', filename, e)
+        for _, entry in sorted(entries, key=lambda x: x[0]):
+            self.entries[entry.key] = entry
+            self.size += entry.size
+        bodies = set(x.body for x in self.entries.values())
+        for filename in glob.glob(os.path.join(self.directory, '*')):
+            if not filename.endswith('.json') and os.path.basename(filename) not in bodies:
+                # unfinished or replaced bodies of a previous run
+                os.remove(filename)
+        self.evict()
+        logging.info('HTTPCache loaded %d objects, %d bytes from %r', len(self.entries), self.size, self.directory)
+
+    def _entry(self, key, meta):
+        headers = dict(meta['headers'])
+        corrected_age, lifetime, must_revalidate = self._freshness(headers, meta['request_time'], meta['response_time'])
+        return HTTPCacheEntry(key, meta['size'], meta['response_time'], corrected_age, lifetime, headers.get('Etag', ''), headers.get('Last-Modified', ''), tuple(meta['vary']), bytes.fromhex(meta['vary_key']), must_revalidate, meta.get('body', key.hex()))
+
+    def lookup(self, url, request_headers):
+        """return the cached entry of url matching the request vary headers, or None"""
+        key = hashlib.sha1(url.encode('utf-8')).digest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+        if entry and entry.vary_key != self._vary_key(entry.vary, request_headers):
+            entry = None
+        if not entry:
+            self.stats['miss'] += 1
+        return entry
+
+    def is_fresh(self, entry, request_headers):
+        directives = self.parse_cache_control(request_headers.get('Cache-Control', ''))
+        if entry.must_revalidate or 'no-cache' in directives or 'no-cache' in request_headers.get('Pragma', ''):
+            return False
+        age = entry.age()
+        max_age = self._parse_seconds(directives.get('max-age'))
+        if max_age is not None and age > max_age:
+            return False
+        return age < entry.lifetime
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def open(self, entry):
+        """return (status, headers list, body file) of entry, or None when its files are gone"""
+        path = self._path(entry.key)
+        try:
+            with open(path + '.json', 'r') as fp:
+                meta = json.load(fp)
+            return meta['status'], meta['headers'] + [['Age', str(int(entry.age()))]], open(os.path.join(self.directory, meta.get('body', entry.key.hex())), 'rb')
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('HTTPCache open %r failed: %r', path, e)
+            self.remove(entry)
+            return None
+
+    def _meta(self, url, status, headers, request_time, vary, request_headers, size):
+        return {'url': url, 'status': status, 'headers': [[k, v] for k, v in headers if k not in self.skip_headers],
+                'request_time': request_time, 'response_time': time.time(), 'size': size,
+                'vary': vary, 'vary_key': self._vary_key(vary, request_headers).hex()}
+
+    def writer(self, url, request_headers, response, request_time):
+        """return a HTTPCacheWriter when the response may be stored by a shared cache, else None"""
+        headers = dict((k.title(), v) for k, v in response.getheaders())
+        directives = self.parse_cache_control(headers.get('Cache-Control', ''))
+        request_directives = self.parse_cache_control(request_headers.get('Cache-Control', ''))
+        vary = sorted(x.strip().title() for x in headers.get('Vary', '').split(',') if x.strip())
+        size = self._parse_seconds(headers.get('Content-Length'))
+        if (response.status not in self.cacheable_status or 'no-store' in directives or 'private' in directives or 'no-store' in request_directives
+                or 'Set-Cookie' in headers or 'Content-Range' in headers or '*' in vary or size is None or size > self.max_object_size
+                or ('Authorization' in request_headers and 'public' not in directives and 's-maxage' not in directives)):
+            self.stats['uncacheable'] += 1
+            return None
+        meta = self._meta(url, response.status, [(k.title(), v) for k, v in response.getheaders()], request_time, vary, request_headers, size)
+        key = hashlib.sha1(url.encode('utf-8')).digest()
+        # every stored version gets a body file of its own, the one its json names
+        meta['body'] = '%s.%s' % (key.hex(), os.urandom(4).hex())
+        entry = self._entry(key, meta)
+        if not entry.lifetime and not (entry.etag or entry.last_modified):
+            # never fresh and cannot be revalidated, storing it is useless
+            self.stats['uncacheable'] += 1
+            return None
+        try:
+            return HTTPCacheWriter(self, entry, meta, os.path.join(self.directory, meta['body']))
+        except OSError as e:
+            logging.warning('HTTPCache create writer of %r failed: %r', url, e)
+            return None
+
+    def _commit(self, entry, meta, body_path):
+        path = self._path(entry.key)
+        try:
+            os.replace(body_path + '.tmp', body_path)
+            with open(body_path + '.json.tmp', 'w') as fp:
+                json.dump(meta, fp)
+            with self.lock:
+                # the json names its body, this one rename publishes the new version whole
+                os.replace(body_path + '.json.tmp', path + '.json')
+                old_entry = self.entries.pop(entry.key, None)
+                if old_entry:
+                    self.size -= old_entry.size
+                self.entries[entry.key] = entry
+                self.size += entry.size
+        except OSError as e:
+            logging.warning('HTTPCache store %r failed: %r', path, e)
+            self._remove_files(body_path, body_path + '.json.tmp')
+            return
+        if old_entry:
+            self._remove_files(os.path.join(self.directory, old_entry.body))
+        self.stats['store'] += 1
+        if self.size > self.max_size:
+            self.evict()
+
+    def refresh(self, entry, response, request_time):
+        """update the stored headers and freshness of entry by a 304 response, rfc 7234 section 4.3.4, return the new entry"""
+        path = self._path(entry.key)
+        body_path = os.path.join(self.directory, entry.body)
+        try:
+            with open(path + '.json', 'r') as fp:
+                meta = json.load(fp)
+            headers = collections.OrderedDict((k, v) for k, v in meta['headers'])
+            headers.update((k.title(), v) for k, v in response.getheaders() if k.title() not in self.skip_headers and k.title() != 'Content-Length')
+            meta['headers'] = [[k, v] for k, v in headers.items()]
+            meta['request_time'] = request_time
+            meta['response_time'] = time.time()
+            new_entry = self._entry(entry.key, meta)
+            with open(body_path + '.json.tmp', 'w') as fp:
+                json.dump(meta, fp)
+            with self.lock:
+                # a newer version or a removal since the lookup wins over this refresh
+                if self.entries.get(entry.key) is not entry or new_entry.body != entry.body:
+                    os.remove(body_path + '.json.tmp')
+                    return entry
+                os.replace(body_path + '.json.tmp', path + '.json')
+                self.entries[entry.key] = new_entry
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('HTTPCache refresh %r failed: %r', path, e)
+            return entry
+        self.stats['revalidated'] += 1
+        return new_entry
+
+    def remove(self, entry):
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                # replaced by a newer version meanwhile, which owns the json now
+                return
+            del self.entries[entry.key]
+            self.size -= entry.size
+            self._remove_files(self._path(entry.key) + '.json')
+        self._remove_files(os.path.join(self.directory, entry.body))
+
+    def _remove_files(self, *filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def dump(self):
+        stats = dict(self.stats)
+        stats.update(objects=len(self.entries), size=self.size)
+        return stats
+
+    def report_stats(self, interval):
+        """log hit, miss and revalidation counters every interval seconds"""
+        while 1:
+            time.sleep(interval)
+            logging.info('HTTPCache stats: %s', self.dump())
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            with self.lock:
+                key, entry = next(iter(self.entries.items()))
+            self.remove(entry)
+            self.stats['evict'] += 1
+
+
 class LocalProxyServer(socketserver.ThreadingTCPServer):
     """Local Proxy Server"""
     allow_reuse_address = True
@@ -1285,7 +4001,11 @@ class LocalProxyServer(socketserver.ThreadingTCPServer):
 class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
 
     bufsize = 256*1024
+    # larger or chunked request bodies are streamed to the fetchserver instead of read into memory
+    max_payload_size = 1024*1024
     first_run_lock = threading.Lock()
+    google_ip_scanner = None
+    http_cache = None
     urlfetch = staticmethod(gae_urlfetch)
     normcookie = functools.partial(re.compile(', ([^ =]+(?:=|$))').sub, '\\r\\nSet-Cookie: \\1')
 
@@ -1374,6 +4094,15 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
                     common.GOOGLE_HOSTS = list(set(x for x in common.CONFIG.get(common.GAE_PROFILE, 'hosts').split('|') if x))
                     common.GOOGLE_WITHGAE = set(common.CONFIG.get('google_hk', 'withgae').split('|'))
             self._update_google_iplist()
+            if common.SCAN_ENABLE:
+                self.__class__.google_ip_scanner = GoogleIPScanner(common.SCAN_RANGES, common.GOOGLE_HOSTS, threads=common.SCAN_THREADS, rate=common.SCAN_RATE, max_pool_size=common.SCAN_POOLSIZE, scoreboard=http_util.ssl_connection_time, callback=self._publish_google_iplist)
+                self.__class__.google_ip_scanner.start()
+
+    @staticmethod
+    def _publish_google_iplist(iplist):
+        for appid in common.GAE_APPIDS:
+            http_util.dns['%s.appspot.com' % appid] = iplist
+        logging.debug('GoogleIPScanner publish iplist=%r', iplist)
 
     def setup(self):
         if isinstance(self.__class__.first_run, collections.Callable):
@@ -1432,11 +4161,21 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
         else:
             self.do_METHOD_GAE()
 
+    def _read_payload(self):
+        """return the request body as bytes, or as a RequestBodyReader when it is chunked or larger than max_payload_size"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return RequestBodyReader(self.rfile)
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > self.max_payload_size:
+            return RequestBodyReader(self.rfile, content_length)
+        return self.rfile.read(content_length) if content_length else b''
+
     def do_METHOD_FWD(self):
         """Direct http forward"""
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            payload = self.rfile.read(content_length) if content_length else b''
+            payload = self._read_payload()
+            if isinstance(payload, RequestBodyReader) and payload.remaining is None:
+                payload = ChunkedPayload(payload)
             if common.HOSTS_MATCH and any(x(self.path) for x in common.HOSTS_MATCH):
                 realhost = next(common.HOSTS_MATCH[x] for x in common.HOSTS_MATCH if x(self.path)) or re.sub(r':\d+$', '', self.parsed_url.netloc)
                 logging.debug('hosts pattern mathed, url=%r realhost=%r', self.path, realhost)
@@ -1449,11 +4188,7 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
             if response.status in (400, 405):
                 common.GAE_CRLF = 0
             self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k.title(), v) for k, v in response.getheaders() if k != 'Transfer-Encoding'))).encode('latin-1'))
-            while 1:
-                data = response.read(8192)
-                if not data:
-                    break
-                self.wfile.write(data)
+            http_util.relay(response, self.connection)
             response.close()
         except OSError as e:
             if e.args[0] in (errno.ECONNRESET, 10063, errno.ENAMETOOLONG):
@@ -1466,6 +4201,48 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
             logging.warn('GAEProxyHandler direct(%s) Error', host)
             raise
 
+    def _gae_urlfetch(self, appid, headers, payload, kwargs):
+        """urlfetch by appid got from appid_scheduler.choose, return (response, appid)"""
+        fetchserver = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, appid, common.GAE_PATH)
+        response = None
+        request_time = time.time()
+        try:
+            response = self.urlfetch(self.command, self.path, headers, payload, fetchserver, **kwargs)
+        finally:
+            appid_scheduler.record(appid, response.app_status if response else 0, time.time() - request_time)
+        return response, appid
+
+    def _send_cached(self, entry):
+        """write a cached response to client, return False when the entry is gone"""
+        cached = self.http_cache.open(entry)
+        if not cached:
+            return False
+        status, headers, fp = cached
+        with fp:
+            logging.info('%s "CACHE %s %s HTTP/1.1" %s %s', self.address_string(), self.command, self.path, status, entry.size)
+            self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (status, ''.join('%s: %s\r\n' % (k, v) for k, v in headers))).encode('latin-1'))
+            http_util.relay(fp, self.connection)
+        self.http_cache.stats['hit'] += 1
+        return True
+
+    def _send_flight(self, flight):
+        """relay the response of an identical in-flight request to client, return False when it cannot be shared"""
+        response = flight.wait_response(urlfetch_flights.timeout)
+        if not response or not flight.matches(self.headers):
+            urlfetch_flights.stats['fallback'] += 1
+            return False
+        status, headers = response
+        logging.info('%s "GAE SHARED %s %s HTTP/1.1" %s %s', self.address_string(), self.command, self.path, status, dict(headers).get('Content-Length', '-'))
+        self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (status, ''.join('%s: %s\r\n' % (k, v) for k, v in headers))).encode('latin-1'))
+        try:
+            for data in flight.iter_body(urlfetch_flights.timeout):
+                self.wfile.write(data)
+        except OSError as e:
+            # the body is cut short, the client only learns it from a closed connection
+            logging.info('GAEProxyHandler._send_flight %r return %r', self.path, e)
+            self.close_connection = 1
+        return True
+
     def do_METHOD_GAE(self):
         """GAE http urlfetch"""
         host = self.headers.get('Host', '')
@@ -1484,89 +4261,164 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
             except StopIteration:
                 pass
 
-        payload = b''
-        if 'Content-Length' in self.headers:
-            try:
-                payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
-            except (EOFError, OSError) as e:
-                logging.error('handle_method_urlfetch read payload failed:%s', e)
+        try:
+            payload = self._read_payload()
+        except (EOFError, OSError) as e:
+            logging.error('handle_method_urlfetch read payload failed:%s', e)
+            return
+        cache_entry = None
+        cache_writer = None
+        if self.http_cache and self.command == 'GET' and not payload and 'Range' not in self.headers:
+            cache_entry = self.http_cache.lookup(self.path, self.headers)
+            if cache_entry and self.http_cache.is_fresh(cache_entry, self.headers) and self._send_cached(cache_entry):
                 return
+            if cache_entry and 'If-None-Match' not in self.headers and 'If-Modified-Since' not in self.headers:
+                for key, value in self.http_cache.conditional_headers(cache_entry).items():
+                    self.headers[key] = value
+            else:
+                cache_entry = None
+        flight = None
+        if self.command == 'GET' and not payload and not cache_entry and not any(x in self.headers for x in ('Range', 'If-None-Match', 'If-Modified-Since', 'If-Range')):
+            flight, leader = urlfetch_flights.join(self.command, self.path, self.headers)
+            if not leader:
+                if self._send_flight(flight):
+                    return
+                flight = None
         response = None
         errors = []
-        for retry in range(common.FETCHMAX_LOCAL):
-            try:
-                content_length = 0
-                kwargs = {}
-                if common.GAE_PASSWORD:
-                    kwargs['password'] = common.GAE_PASSWORD
-                if common.GAE_VALIDATE:
-                    kwargs['validate'] = 1
-                response = self.urlfetch(self.command, self.path, self.headers, payload, common.GAE_FETCHSERVER, **kwargs)
-                if not response and retry == common.FETCHMAX_LOCAL-1:
+        try:
+            for retry in range(common.FETCHMAX_LOCAL):
+                if retry and getattr(payload, 'consumed', 0):
+                    # a streamed upload cannot be replayed
                     html = message_html('502 URLFetch failed', 'Local URLFetch %r failed' % self.path, str(errors))
                     self.wfile.write(b'HTTP/1.0 502\r\nContent-Type: text/html\r\n\r\n' + html.encode('utf-8'))
                     return
-                # gateway error, switch to https mode
-                if response.app_status in (400, 504) or (response.app_status == 502 and common.GAE_PROFILE == 'google_cn'):
-                    common.GOOGLE_MODE = 'https'
-                    common.GAE_FETCHSERVER = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, common.GAE_APPIDS[0], common.GAE_PATH)
-                    continue
-                # appid over qouta, switch to next appid
-                if response.app_status == 503:
-                    common.GAE_APPIDS.append(common.GAE_APPIDS.pop(0))
-                    common.GAE_FETCHSERVER = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, common.GAE_APPIDS[0], common.GAE_PATH)
-                    http_util.dns[urllib.parse.urlparse(common.GAE_FETCHSERVER).netloc] = common.GOOGLE_HOSTS
-                    logging.info('APPID Over Quota,Auto Switch to [%s]' % (common.GAE_APPIDS[0]))
-                    continue
-                # bad request, disable CRLF injection
-                if response.app_status in (400, 405):
-                    http_util.crlf = 0
-                    continue
-                if response.app_status != 200 and retry == common.FETCHMAX_LOCAL-1:
-                    logging.info('%s "GAE %s %s HTTP/1.1" %s -', self.address_string(), self.command, self.path, response.status)
-                    self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k.title(), v) for k, v in response.getheaders() if k != 'Transfer-Encoding'))).encode('latin-1'))
-                    self.wfile.write(response.read())
-                    response.close()
+                cooldown = appid_scheduler.cooldown()
+                if cooldown > appid_scheduler.max_wait:
+                    # every appid is over quota, retrying them at once only burns requests
+                    logging.warning('GAEProxyHandler.do_METHOD_GAE %r all appids cooling down for %ds', self.path, cooldown)
+                    html = message_html('503 Over Quota', 'All appids of %r are over quota' % self.path, str(errors))
+                    self.wfile.write(('HTTP/1.0 503\r\nRetry-After: %d\r\nContent-Type: text/html\r\n\r\n' % cooldown).encode('latin-1') + html.encode('utf-8'))
                     return
-                # first response, has no retry.
-                if retry == 0:
-                    logging.info('%s "GAE %s %s HTTP/1.1" %s %s', self.address_string(), self.command, self.path, response.status, response.getheader('Content-Length', '-'))
-                    if response.status == 206:
-                        fetchservers = [re.sub(r'//\w+\.appspot\.com', '//%s.appspot.com' % appid, common.GAE_FETCHSERVER) for appid in common.GAE_APPIDS]
-                        rangefetch = RangeFetch(self.wfile, response, self.command, self.path, self.headers, payload, fetchservers, common.GAE_PASSWORD, maxsize=common.AUTORANGE_MAXSIZE, bufsize=common.AUTORANGE_BUFSIZE, waitsize=common.AUTORANGE_WAITSIZE, threads=common.AUTORANGE_THREADS)
-                        return rangefetch.fetch()
-                    if 'Set-Cookie' in response.headers:
-                        response.headers['Set-Cookie'] = self.normcookie(response.headers['Set-Cookie'])
-                    self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k.title(), v) for k, v in response.getheaders() if k != 'Transfer-Encoding'))).encode('latin-1'))
-                content_length = int(response.headers.get('Content-Length', 0))
-                if response.headers.get('Content-Range'):
-                    content_range = response.headers['Content-Range']
-                    start, end, length = list(map(int, re.search(r'bytes (\d+)-(\d+)/(\d+)', content_range).group(1, 2, 3)))
-                else:
-                    start, end, length = 0, content_length-1, content_length
-                while 1:
-                    data = response.read(8192)
-                    if not data:
+                elif cooldown:
+                    time.sleep(cooldown)
+                try:
+                    content_length = 0
+                    kwargs = {}
+                    if common.GAE_PASSWORD:
+                        kwargs['password'] = common.GAE_PASSWORD
+                    if common.GAE_VALIDATE:
+                        kwargs['validate'] = 1
+                    request_time = time.time()
+                    appid = appid_scheduler.choose()
+                    other_appids = [x for x in common.GAE_APPIDS if x != appid]
+                    if common.GAE_HEDGE and self.command in ('GET', 'HEAD') and not payload and other_appids and not appid_scheduler.cooldown(other_appids):
+                        # idempotent, a slow appid or front-end ip gets raced by another appid, racing the same appid only doubles its quota use
+                        secondary = lambda: self._gae_urlfetch(appid_scheduler.choose(other_appids), copy.copy(self.headers), payload, kwargs)
+                        response, appid = request_hedger.fetch(host, lambda: self._gae_urlfetch(appid, self.headers, payload, kwargs), secondary)
+                    else:
+                        response, appid = self._gae_urlfetch(appid, self.headers, payload, kwargs)
+                    if not response and retry == common.FETCHMAX_LOCAL-1:
+                        html = message_html('502 URLFetch failed', 'Local URLFetch %r failed' % self.path, str(errors))
+                        self.wfile.write(b'HTTP/1.0 502\r\nContent-Type: text/html\r\n\r\n' + html.encode('utf-8'))
                         return
-                    start += len(data)
-                    self.wfile.write(data)
-                    if start >= end:
+                    # gateway error, switch to https mode
+                    if response.app_status in (400, 504) or (response.app_status == 502 and common.GAE_PROFILE == 'google_cn'):
+                        common.GOOGLE_MODE = 'https'
+                        common.GAE_FETCHSERVER = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, common.GAE_APPIDS[0], common.GAE_PATH)
+                        continue
+                    # appid over qouta, the scheduler cools it down and the retry goes to the next healthiest appid
+                    if response.app_status == 503 and retry < common.FETCHMAX_LOCAL-1:
+                        logging.info('APPID %r Over Quota, retry with another appid', appid)
+                        continue
+                    # bad request, disable CRLF injection
+                    if response.app_status in (400, 405):
+                        http_util.crlf = 0
+                        continue
+                    if response.app_status != 200 and retry == common.FETCHMAX_LOCAL-1:
+                        logging.info('%s "GAE %s %s HTTP/1.1" %s -', self.address_string(), self.command, self.path, response.status)
+                        self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k.title(), v) for k, v in response.getheaders() if k != 'Transfer-Encoding'))).encode('latin-1'))
+                        self.wfile.write(response.read())
+                        response.close()
                         return
-            except Exception as e:
-                errors.append(e)
-                if e.args[0] in (errno.ECONNABORTED, errno.EPIPE):
-                    logging.info('GAEProxyHandler.do_METHOD_GAE %r return %r', self.path, e)
-                elif e.args[0] in (errno.ECONNRESET, errno.ETIMEDOUT, errno.ENETUNREACH, 11004):
-                    # connection reset or timeout, switch to https
-                    common.GOOGLE_MODE = 'https'
-                    common.GAE_FETCHSERVER = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, common.GAE_APPIDS[0], common.GAE_PATH)
-                elif e.args[0] == errno.ETIMEDOUT or isinstance(e.args[0], str) and 'timed out' in e.args[0]:
-                    if content_length:
-                        # we can retry range fetch here
-                        logging.warn('GAEProxyHandler.do_METHOD_GAE timed out, url=%r, content_length=%r, try again', self.path, content_length)
-                        self.headers['Range'] = 'bytes=%d-%d' % (start, end)
-                else:
-                    logging.exception('GAEProxyHandler.do_METHOD_GAE %r return %r', self.path, e)
+                    if cache_entry and response.status == 304:
+                        # revalidated by our own conditional request on any attempt, client gets the stored copy
+                        cache_entry = self.http_cache.refresh(cache_entry, response, request_time)
+                        response.close()
+                        if self._send_cached(cache_entry):
+                            return
+                        # stored body vanished meanwhile, fetch it again unconditionally
+                        for key in ('If-None-Match', 'If-Modified-Since'):
+                            del self.headers[key]
+                        return self.do_METHOD_GAE()
+                    # first response, has no retry.
+                    if retry == 0:
+                        logging.info('%s "GAE %s %s HTTP/1.1" %s %s', self.address_string(), self.command, self.path, response.status, response.getheader('Content-Length', '-'))
+                        if response.status == 206:
+                            appid_scheduler.account(appid, int(response.getheader('Content-Length', 0)))
+                            fetchservers = ['%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, x, common.GAE_PATH) for x in common.GAE_APPIDS]
+                            rangefetch = RangeFetch(self.wfile, response, self.command, self.path, self.headers, payload, fetchservers, common.GAE_PASSWORD, maxsize=common.AUTORANGE_MAXSIZE, bufsize=common.AUTORANGE_BUFSIZE, waitsize=common.AUTORANGE_WAITSIZE, threads=common.AUTORANGE_THREADS, minsize=common.AUTORANGE_MINSIZE, maxthreads=common.AUTORANGE_MAXTHREADS, target_speed=common.AUTORANGE_SPEED, scheduler=appid_scheduler)
+                            return rangefetch.fetch()
+                        if self.http_cache and self.command == 'GET' and not payload and not response.getheader('Content-Range'):
+                            cache_writer = self.http_cache.writer(self.path, self.headers, response, request_time)
+                            if cache_entry and not cache_writer:
+                                self.http_cache.remove(cache_entry)
+                        if flight and not urlfetch_flights.shareable(response):
+                            urlfetch_flights.close(flight)
+                            flight = None
+                        if 'Set-Cookie' in response.headers:
+                            response.headers['Set-Cookie'] = self.normcookie(response.headers['Set-Cookie'])
+                        headers = [(k.title(), v) for k, v in response.getheaders() if k != 'Transfer-Encoding']
+                        if flight:
+                            flight.start(response.status, headers)
+                        self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k, v) for k, v in headers))).encode('latin-1'))
+                    content_length = int(response.headers.get('Content-Length', 0))
+                    if response.headers.get('Content-Range'):
+                        content_range = response.headers['Content-Range']
+                        start, end, length = list(map(int, re.search(r'bytes (\d+)-(\d+)/(\d+)', content_range).group(1, 2, 3)))
+                    else:
+                        start, end, length = 0, content_length-1, content_length
+
+                    def relayed(data, appid=appid):
+                        nonlocal start
+                        start += len(data)
+                        appid_scheduler.account(appid, len(data))
+                        if cache_writer:
+                            cache_writer.write(data)
+                        if flight:
+                            # data is a view of a pooled buffer
+                            flight.write(bytes(data))
+                    http_util.relay(response, self.connection, callback=relayed)
+                    if cache_writer:
+                        cache_writer.close()
+                    if flight:
+                        urlfetch_flights.close(flight, start > end)
+                    return
+                except Exception as e:
+                    errors.append(e)
+                    if cache_writer:
+                        cache_writer.close()
+                        cache_writer = None
+                    if flight:
+                        urlfetch_flights.close(flight)
+                        flight = None
+                    if e.args[0] in (errno.ECONNABORTED, errno.EPIPE):
+                        logging.info('GAEProxyHandler.do_METHOD_GAE %r return %r', self.path, e)
+                    elif e.args[0] in (errno.ECONNRESET, errno.ETIMEDOUT, errno.ENETUNREACH, 11004):
+                        # connection reset or timeout, switch to https
+                        common.GOOGLE_MODE = 'https'
+                        common.GAE_FETCHSERVER = '%s://%s.appspot.com%s?' % (common.GOOGLE_MODE, common.GAE_APPIDS[0], common.GAE_PATH)
+                    elif e.args[0] == errno.ETIMEDOUT or isinstance(e.args[0], str) and 'timed out' in e.args[0]:
+                        if content_length:
+                            # we can retry range fetch here
+                            logging.warn('GAEProxyHandler.do_METHOD_GAE timed out, url=%r, content_length=%r, try again', self.path, content_length)
+                            self.headers['Range'] = 'bytes=%d-%d' % (start, end)
+                    else:
+                        logging.exception('GAEProxyHandler.do_METHOD_GAE %r return %r', self.path, e)
+        finally:
+            if flight:
+                # leader gives up, identical requests fall back to fetch by themselves
+                urlfetch_flights.close(flight)
 
     def do_CONNECT(self):
         """handle CONNECT cmmand, socket forward or deploy a fake cert"""
@@ -1604,6 +4456,7 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
                     else:
                         raise
             if hasattr(remote, 'fileno'):
+                self.close_connection = 1
                 http_util.forward_socket(self.connection, remote, bufsize=self.bufsize)
         else:
             hostip = random.choice(common.GOOGLE_HOSTS)
@@ -1612,18 +4465,18 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
                 logging.error('GAEProxyHandler proxy connect remote (%r, %r) failed', host, port)
                 return
             self.wfile.write(b'HTTP/1.1 200 OK\r\n\r\n')
+            self.close_connection = 1
             http_util.forward_socket(self.connection, remote, bufsize=self.bufsize)
 
     def do_CONNECT_AGENT(self):
         """deploy fake cert to client"""
         host, _, port = self.path.rpartition(':')
         port = int(port)
-        certfile = CertUtil.get_cert(host)
         logging.info('%s "AGENT %s %s:%d HTTP/1.1" - -', self.address_string(), self.command, host, port)
         self.__realconnection = None
         self.wfile.write(b'HTTP/1.1 200 OK\r\n\r\n')
         try:
-            ssl_sock = ssl.wrap_socket(self.connection, certfile=certfile, keyfile=certfile, server_side=True, ssl_version=ssl.PROTOCOL_SSLv23)
+            ssl_sock = CertUtil.get_ssl_context(host).wrap_socket(self.connection, server_side=True)
         except Exception as e:
             if e.args[0] not in (errno.ECONNABORTED, errno.ECONNRESET):
                 logging.error('ssl.wrap_socket(self.connection=%r) failed: %s', self.connection, e)
@@ -1669,14 +4522,8 @@ class GAEProxyHandler(http.server.BaseHTTPRequestHandler):
 
 
 def paas_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
-    # deflate = lambda x:zlib.compress(x)[2:-4]
     if payload:
-        if len(payload) < 10 * 1024 * 1024 and 'Content-Encoding' not in headers:
-            zpayload = zlib.compress(payload)[2:-4]
-            if len(zpayload) < len(payload):
-                payload = zpayload
-                headers['Content-Encoding'] = 'deflate'
-        headers['Content-Length'] = str(len(payload))
+        payload = deflate_payload(payload, headers)
     skip_headers = http_util.skip_headers
     if 'xorchar' not in kwargs and fetchserver.startswith('http://'):
         kwargs['xorchar'] = random.choice(kwargs.get('password') or 'goagent')
@@ -1684,7 +4531,8 @@ def paas_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
         kwargs['validate'] = 1
     metadata = 'G-Method:%s\nG-Url:%s\n%s%s' % (method, url, ''.join('G-%s:%s\n' % (k, v) for k, v in kwargs.items() if v), ''.join('%s:%s\n' % (k, v) for k, v in headers.items() if k not in skip_headers))
     metadata = zlib.compress(metadata.encode('latin-1'))[2:-4]
-    app_payload = b''.join((struct.pack('!h', len(metadata)), metadata, payload))
+    prefix = struct.pack('!h', len(metadata)) + metadata
+    app_payload = payload.prepend(prefix) if isinstance(payload, StreamPayload) else prefix + payload
     fetchserver += '?%s' % random.random()
     response = http_util.request('POST', fetchserver, app_payload, {'Content-Length': len(app_payload)}, crlf=0)
     if not response:
@@ -1693,10 +4541,8 @@ def paas_urlfetch(method, url, headers, payload, fetchserver, **kwargs):
     if 'x-status' in response.headers:
         response.status = int(response.headers['x-status'])
         del response.headers['x-status']
-    response_read = response.read
     if 'xorchar' in kwargs and 200 <= response.app_status < 400:
-        ordchar = ord(kwargs['xorchar'])
-        response.read = lambda n: bytes(c ^ ordchar for c in response_read(n))
+        XORCodec(kwargs['xorchar']).wrap(response)
     return response
 
 
@@ -1741,16 +4587,17 @@ class PAASProxyHandler(GAEProxyHandler):
     def do_METHOD(self):
         try:
             host = self.headers.get('Host', '')
-            payload = b''
-            if 'Content-Length' in self.headers:
-                try:
-                    payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
-                except (EOFError, OSError) as e:
-                    logging.error('handle_method read payload failed:%s', e)
-                    return
+            try:
+                payload = self._read_payload()
+            except (EOFError, OSError) as e:
+                logging.error('handle_method read payload failed:%s', e)
+                return
             response = None
             errors = []
             for i in range(common.FETCHMAX_LOCAL):
+                if i and getattr(payload, 'consumed', 0):
+                    # a streamed upload cannot be replayed
+                    break
                 try:
                     kwargs = {}
                     if common.PAAS_PASSWORD:
@@ -1778,11 +4625,7 @@ class PAASProxyHandler(GAEProxyHandler):
                 response.headers['Set-Cookie'] = re.sub(', ([^ =]+(?:=|$))', '\\r\\nSet-Cookie: \\1', response.headers['Set-Cookie'])
             self.wfile.write(('HTTP/1.1 %s\r\n%s\r\n' % (response.status, ''.join('%s: %s\r\n' % (k.title(), v) for k, v in response.getheaders() if k.title() != 'Transfer-Encoding'))).encode('latin-1'))
 
-            while 1:
-                data = response.read(32768)
-                if not data:
-                    break
-                self.wfile.write(data)
+            http_util.relay(response, self.connection)
             response.close()
 
         except OSError as e:
@@ -1936,36 +4779,118 @@ class DNSServer(socketserver.ThreadingUDPServer):
     max_wait = 1
     max_retry = 2
     max_cache_size = 2000
+    negative_ttl = 5
+    default_ttl = 60
     timeout = 6
+    prefetch_hits = 3
+    prefetch_ratio = 0.9
+    min_prefetch_ttl = 10
+    max_prefetch = 4
 
     def __init__(self, server_address, *args, **kwargs):
         socketserver.ThreadingUDPServer.__init__(self, server_address, self.handle, *args, **kwargs)
         self._writelock = threading.Semaphore()
-        self.cache = {}
+        # (qname, qtype, qclass) -> (reply message, fetch time, prefetched), concurrent queries of a question share one upstream query
+        self.cache = DNSCache(max_size=self.max_cache_size, negative_ttl=self.negative_ttl)
+        self.stats = collections.Counter()
+        # question -> queries since last fetch, hot questions are refreshed ahead of their ttl
+        self.hits = collections.Counter()
+        self.prefetch_queue = []
+        self.prefetch_due = {}
+        self.prefetch_condition = threading.Condition()
+        self.prefetch_semaphore = None
+        self.prefetch_thread_started = False
+
+    def _reply_ttl(self, message):
+        ttls = [x.ttl for x in message.answers] or [min(x.ttl, x.data[-1]) for x in message.authorities if x.type == DNSUtil.TYPE_SOA]
+        return min(ttls) if ttls else self.default_ttl
+
+    def _resolve(self, key, prefetch=False):
+        qname, qtype, qclass = key
+        logging.info('DNSServer resolve domain=%r by dnsservers=%r to iplist', qname, self.dnsservers)
+        self.stats['prefetch' if prefetch else 'upstream'] += 1
+        data = DNSUtil._remote_resolve(self.dnsservers, qname, self.timeout, qtype)
+        if not data:
+            raise socket.error(errno.ETIMEDOUT, 'DNSServer resolve domain=%r return data=%r' % (qname, data))
+        try:
+            message = DNSUtil.parse_message(data)
+        except ValueError as e:
+            raise socket.error('DNSServer resolve domain=%r return %s' % (qname, e))
+        logging.info('DNSServer resolve domain=%r return iplist=%s', qname, [x.data for x in message.answers if x.type in (DNSUtil.TYPE_A, DNSUtil.TYPE_AAAA)])
+        ttl = self._reply_ttl(message)
+        self._schedule_prefetch(key, ttl)
+        return (message, time.time(), prefetch), ttl
+
+    def _schedule_prefetch(self, key, ttl):
+        with self.prefetch_condition:
+            self.hits.pop(key, None)
+            if ttl < self.min_prefetch_ttl:
+                self.prefetch_due.pop(key, None)
+                return
+            due = self.prefetch_due[key] = time.time() + ttl * self.prefetch_ratio
+            heapq.heappush(self.prefetch_queue, (due, key))
+            if not self.prefetch_thread_started:
+                self.prefetch_thread_started = True
+                self.prefetch_semaphore = threading.BoundedSemaphore(self.max_prefetch)
+                threading._start_new_thread(self._prefetch_loop, ())
+            self.prefetch_condition.notify()
+
+    def _prefetch_loop(self):
+        while 1:
+            with self.prefetch_condition:
+                while not self.prefetch_queue or self.prefetch_queue[0][0] > time.time():
+                    self.prefetch_condition.wait(self.prefetch_queue[0][0] - time.time() if self.prefetch_queue else None)
+                due, key = heapq.heappop(self.prefetch_queue)
+                if self.prefetch_due.get(key) != due:
+                    # superseded by a later fetch
+                    continue
+                del self.prefetch_due[key]
+                hits = self.hits.pop(key, 0)
+            if hits < self.prefetch_hits or key not in self.cache:
+                # gone cold or evicted, let it expire
+                self.stats['prefetch_cold'] += 1
+                continue
+            self.prefetch_semaphore.acquire()
+            threading._start_new_thread(self._prefetch, (key,))
+
+    def _prefetch(self, key):
+        try:
+            self.cache._refresh(key, functools.partial(self._resolve, prefetch=True))
+        finally:
+            self.prefetch_semaphore.release()
 
     def handle(self, request, address, server):
         data, server_socket = request
-        reqid = data[:2]
-        domain = data[12:data.find(b'\x00', 12)].decode('latin-1')
-        if len(self.cache) > self.max_cache_size:
-            self.cache.clear()
-        if domain not in self.cache:
-            qname = re.sub(r'[\x01-\x29]', '.', domain[1:])
-            try:
-                dnsserver = random.choice(self.dnsservers)
-                logging.info('DNSServer resolve domain=%r by dnsserver=%r to iplist', qname, dnsserver)
-                data = DNSUtil._remote_resolve(dnsserver, qname, self.timeout)
-                if not data:
-                    logging.warning('DNSServer resolve domain=%r return data=%s', qname, data)
-                    return
-                iplist = DNSUtil._reply_to_iplist(data)
-                self.cache[domain] = data
-                logging.info('DNSServer resolve domain=%r return iplist=%s', qname, iplist)
-            except OSError as e:
-                logging.error('DNSServer resolve domain=%r to iplist failed:%s', qname, e)
+        self.stats['query'] += 1
+        try:
+            query = DNSUtil.parse_message(data)
+            qname, qtype, qclass = query.questions[0]
+        except (ValueError, IndexError) as e:
+            logging.warning('DNSServer receive malformed query from %r: %s', address, e)
+            return
+        key = (qname.lower(), qtype, qclass)
+        with self.prefetch_condition:
+            while len(self.hits) > self.cache.max_size:
+                # failed and uncached questions are never fetched again, decay the counts so they age out and hot ones stay hot
+                self.hits = collections.Counter({k: v >> 1 for k, v in self.hits.items() if v > 1})
+            self.hits[key] += 1
+        try:
+            result = self.cache.resolve(key, self._resolve)
+        except OSError as e:
+            logging.error('DNSServer resolve domain=%r to iplist failed:%s', qname, e)
+            return
+        if not result:
+            return
+        message, fetch_time, prefetched = result
+        if prefetched:
+            self.stats['prefetched_hit'] += 1
+        # decay the ttls by cached time, and reply with the id and question of this query
+        elapsed = int(time.time() - fetch_time)
+        decay = lambda records: [x if x.type == DNSUtil.TYPE_OPT else x._replace(ttl=max(x.ttl-elapsed, 0)) for x in records]
+        message = message._replace(id=query.id, questions=query.questions, answers=decay(message.answers), authorities=decay(message.authorities), additionals=decay(message.additionals))
         self._writelock.acquire()
         try:
-            server_socket.sendto(reqid + self.cache[domain], address)
+            server_socket.sendto(DNSUtil.pack_message(message), address)
         finally:
             self._writelock.release()
 
@@ -2026,6 +4951,13 @@ def main():
     logging.basicConfig(level=logging.DEBUG if common.LISTEN_DEBUGINFO else logging.INFO, format='%(levelname)s - %(asctime)s %(message)s', datefmt='[%b %d %H:%M:%S]')
     pre_start()
     CertUtil.check_ca()
+    http_util.load_connection_scores(http_util.connection_score_file)
+    threading._start_new_thread(http_util.save_connection_scores, (http_util.connection_score_file, 300))
+    if common.AUTORANGE_STOREDIR:
+        RangeFetch.store = RangeStore(common.AUTORANGE_STOREDIR, common.AUTORANGE_STORESIZE)
+    if common.CACHE_ENABLE:
+        GAEProxyHandler.http_cache = HTTPCache(common.CACHE_DIR, common.CACHE_SIZE, common.CACHE_MAXOBJECT)
+        threading._start_new_thread(GAEProxyHandler.http_cache.report_stats, (300,))
     sys.stdout.write(common.info())
 
     if common.PAAS_ENABLE:
@@ -2045,9 +4977,9 @@ def main():
     if common.DNS_ENABLE:
         host, port = common.DNS_LISTEN.split(':')
         server = DNSServer((host, int(port)))
-        server.remote_addresses = common.DNS_REMOTE.split('|')
+        server.dnsservers = common.DNS_REMOTE.split('|')
         server.timeout = common.DNS_TIMEOUT
-        server.max_cache_size = common.DNS_CACHESIZE
+        server.cache.max_size = common.DNS_CACHESIZE
         threading._start_new_thread(server.serve_forever, tuple())
 
     server = LocalProxyServer((common.LISTEN_IP, common.LISTEN_PORT), GAEProxyHandler)